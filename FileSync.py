@@ -26,9 +26,42 @@ import socket
 import os
 import time
 import logging
+import logging.handlers
 import inspect
+import itertools
+import io
+import array
+import atexit
+import bisect
 import configparser
+import contextlib
+import collections
+import concurrent.futures
+import cProfile
+import ctypes
+import ctypes.util
+import hashlib
+import http.server
+import json
+import lzma
+import math
+import queue
+import select
+import shutil
+import sqlite3
+import ssl
+import stat
+import struct
 import sys
+import threading
+import tracemalloc
+import weakref
+import zlib
+
+try:
+    import zstandard
+except ImportError:     # zstd is optional
+    zstandard = None
 
 
 class FileSync():
@@ -43,30 +76,118 @@ class FileSync():
     String constants:
     CM_FETCH_DIR -- command of fetch directory information.
     CM_FETCH_FILE -- command of fetch file information.
-    CM_FETCH_NAME -- command of fetch file name.
-    CM_FETCH_TIME -- command of fetch last sync time.
     CM_PUSH_DIR -- command of push directory.
     CM_PUSH_FILE -- command of push file.
+    CM_FETCH_DELTA -- command of fetch delta of file against a signature.
+    CM_FETCH_BATCH -- command of fetch files listed in one MSG_LIST frame,
+    which are answered in one MSG_BUNDLE frame.
+    CM_PUSH_BUNDLE -- command of push files in one MSG_BUNDLE frame.
+    CM_HELLO -- command of negotiate the codec of compression.
+    CM_FETCH_TREE -- command of fetch the digests and children of the
+    directories listed in one MSG_LIST frame.
+    CM_FETCH_HASH -- command of fetch content hash of the files listed in
+    one MSG_LIST frame.
+    CM_FETCH_SIZE -- command of fetch content hash of the files under the
+    folder in one MSG_DATA frame whose size is listed in one MSG_LIST frame.
+    CM_COPY_FILE -- command of copy a remote file to a new path info,
+    answered by an empty MSG_DATA frame, or MSG_ERR if the copy failed.
+    CM_FETCH_RESUME -- command of fetch file, resumed from the checkpoint
+    offered in a MSG_FROM frame.
+    CM_PUSH_DELTA -- command of push file, by delta if remote has a copy,
+    or resumed from the checkpoint remote offers in a MSG_FROM frame.
+    CM_RELAY -- command of push the folder just received on to the peers
+    in one MSG_DATA frame, answered by count of peers reached.
     CM_SEND_OVER -- command of send over.
     CM_SYNC_OVER -- command of sync over.
+
+    Frame types:
+    Every message on the socket is a frame, one type byte and an 8 bytes
+    length, followed by the payload.
+    MSG_CMD -- payload is one of the CM_* commands.
+    MSG_DATA -- payload is a name, a path info or the file content.
+    MSG_LIST -- payload is a batch of path info, separated by "\0".
+    MSG_ERR -- payload is the error message of a failed request.
+    MSG_SIG -- payload is block signature of a file, empty if no file.
+    MSG_DELTA -- payload is one delta instruction, "C" with first block
+    and count of blocks to copy from the old file, or "L" with literal data.
+    MSG_BUNDLE -- payload is many small files, a manifest of name, size and
+    mtime of each file, then the content of the files one after another.
+    MSG_ZDATA -- payload is codec id and a piece of compressed file content,
+    the stream ends with CM_SEND_OVER.
+    MSG_ZLIST -- payload is codec id and a compressed MSG_LIST payload.
+    MSG_ZBUNDLE -- payload is codec id and a compressed MSG_BUNDLE payload.
+    MSG_FROM -- payload is an offset and the hash of whole file. From the
+    receiver it offers a checkpoint, from the sender it leads the content
+    sent from that offset.
+    MSG_ITEMS -- payload is a part of a Listing, packed in columns.
+    MSG_ZITEMS -- payload is codec id and a compressed MSG_ITEMS payload.
     """
 
     # customize comand string of socket transform
     CM_FETCH_DIR = "<-fetch_info->".encode()
     CM_FETCH_FILE = "<-fetch_file->".encode()
-    CM_FETCH_NAME = "<-fetch_name->".encode()
-    CM_FETCH_TIME = "<-fetch_time->".encode()
     CM_PUSH_DIR = "<-push_dir->".encode()
     CM_PUSH_FILE = "<-push_file->".encode()
+    CM_FETCH_DELTA = "<-fetch_delta->".encode()
+    CM_FETCH_BATCH = "<-fetch_batch->".encode()
+    CM_PUSH_BUNDLE = "<-push_bundle->".encode()
+    CM_HELLO = "<-hello->".encode()
+    CM_FETCH_TREE = "<-fetch_tree->".encode()
+    CM_FETCH_HASH = "<-fetch_hash->".encode()
+    CM_FETCH_SIZE = "<-fetch_size->".encode()
+    CM_COPY_FILE = "<-copy_file->".encode()
+    CM_FETCH_RESUME = "<-fetch_resume->".encode()
+    CM_PUSH_DELTA = "<-push_delta->".encode()
+    CM_RELAY = "<-relay->".encode()
     CM_SEND_OVER = "<-send_over->".encode()
     CM_SYNC_OVER = "<-sync_over->".encode()
+
+    # type of message frame
+    MSG_CMD = 1
+    MSG_DATA = 2
+    MSG_LIST = 3
+    MSG_ERR = 4
+    MSG_SIG = 5
+    MSG_DELTA = 6
+    MSG_BUNDLE = 7
+    MSG_ZDATA = 8
+    MSG_ZLIST = 9
+    MSG_ZBUNDLE = 10
+    MSG_FROM = 11
+    MSG_ITEMS = 12
+    MSG_ZITEMS = 13
+    FRAME_HEAD = struct.Struct("!BQ")
+    SIG_HEAD = struct.Struct("!I")      # block size
+    SIG_ITEM = struct.Struct("!I16s")   # weak checksum, strong hash of block
+    DELTA_COPY = struct.Struct("!QQ")   # first block, count of blocks
+    BUNDLE_HEAD = struct.Struct("!I")   # count of files in bundle
+    BUNDLE_ITEM = struct.Struct("!IQQ") # length of name, size, mtime_ns of file
+    RESUME = struct.Struct("!Q16s")     # offset, hash of whole file
+    PARTIAL = ".filesync.partial"       # suffix of file being received
+    CHECKPOINT = ".filesync.ckpt"       # suffix of checkpoint of a partial file
+    TRANSIENT = (PARTIAL, CHECKPOINT, CHECKPOINT + ".tmp")  # suffixes of files never synced
+    CODECS = {"zlib": 1, "lzma": 2, "zstd": 3}
+    # content of these is compressed already
+    PACKED = {".7z", ".avi", ".bz2", ".docx", ".flac", ".gif", ".gz", ".jpeg", ".jpg", ".lz4",
+              ".mkv", ".mov", ".mp3", ".mp4", ".ogg", ".png", ".pptx", ".rar", ".tgz", ".webm",
+              ".webp", ".xlsx", ".xz", ".zip", ".zst"}
+    LIST_BATCH = 65536  # bytes of path info packed in one MSG_LIST frame
+    ITEMS_BATCH = 2048  # entries of a Listing packed in one MSG_ITEMS frame
+    SCAN_BATCH = 256    # entries stat in one task of the scanner
     
 
-    def __init__(self):
-        """Init the class of FileSync."""
+    def __init__(self, configfile=None):
+        """Init the class of FileSync.
+
+        configfile -- path of the config file, default is config.ini
+        next to this file.
+        """
 
         this_file = inspect.getfile(inspect.currentframe())
         self.dirpath = os.path.abspath(os.path.dirname(this_file))
+        if configfile is None:
+            configfile = os.path.join(self.dirpath, "config.ini")
+        self.configfile = configfile
 
         self.synctime = self.readconfig("time", "synctime")
         self.localpath = self.readconfig("folder", "local")
@@ -75,15 +196,94 @@ class FileSync():
         self.serverip = self.readconfig("host","server")
         self.port = int(self.readconfig("host","port"))
         self.needsync = self.readconfig("status","needsync")  #to determine whether sync service need to start.
+        self.chunksize = int(self.readconfig("transfer","chunksize","1048576"))
+        self.local = threading.local()  # buffer of each thread
+        self.deltamin = int(self.readconfig("transfer","deltamin","1048576"))   # smaller file is sent whole
+        self.indexfile = os.path.join(os.path.dirname(os.path.abspath(self.configfile)),
+                                      self.readconfig("index","file","manifest.db"))
+        self.index = None   # manifest index of local folder, open when first used
+        self.indexlock = threading.Lock()
+        self.scanners = int(self.readconfig("index","scanners","8"))  # threads reading directories
+        self.indextrust = self.readconfig("index","trust","false").lower() == "true"  # skip stat of files in unchanged dirs
+        self.versiondir = os.path.join(os.path.dirname(os.path.abspath(self.configfile)),
+                                       self.readconfig("versions","dir","versions"))
+        self.versionchunk = int(self.readconfig("versions","chunk","262144"))   # bytes of one stored chunk
+        self.keepversions = int(self.readconfig("versions","keep","10"))   # versions of a file, 0 is no limit
+        self.keepdays = float(self.readconfig("versions","days","30"))     # days of a version, 0 is no limit
+        self.versions = None    # version store database, open when first used
+        self.versionlock = threading.Lock()
+        self.saving = 0     # count of versions being saved, chunks are not collected meanwhile
+        self.watchmethod = self.readconfig("watch","method","auto")
+        self.debounce = float(self.readconfig("watch","debounce","0.3"))
+        self.pollinterval = float(self.readconfig("watch","interval","2"))
+        self.fullsync = float(self.readconfig("watch","fullsync","3600"))
+        self.written = None     # path -> mtime_ns of files received from remote, kept while watching
+        self.maxconn = int(self.readconfig("server","maxconn","64"))
+        self.idletimeout = float(self.readconfig("server","idletimeout","300"))
+        self.readtimeout = float(self.readconfig("server","readtimeout","60"))
+        self.pathlocks = [threading.Lock() for i in range(256)]
+        self.workers = int(self.readconfig("transfer","workers","4"))     # connects used for one sync
+        self.pipeline = int(self.readconfig("transfer","pipeline","32"))  # fetch requests in flight on a connect
+        self.batchsize = int(self.readconfig("transfer","batchsize","65536"))     # smaller files are fetched in batch
+        self.batchcount = int(self.readconfig("transfer","batchcount","1024"))
+        self.bundlesize = int(self.readconfig("transfer","bundlesize","4194304"))  # bytes of one batch
+        self.dedupmin = int(self.readconfig("transfer","dedupmin","4096"))  # smaller files are not hashed
+        self.resumemin = int(self.readconfig("transfer","resumemin","16777216"))  # smaller files restart
+        self.checkpoint = int(self.readconfig("transfer","checkpoint","67108864"))  # bytes between checkpoints
+        self.fsync = self.readconfig("transfer","fsync","true").lower() == "true"  # received files are durable
+        self.syncfs = None  # syncfs of libc, looked up when first used
+        if self.readconfig("transfer","syncfs","false").lower() != "true":
+            self.syncfs = False     # it flushes every dirty page of the file system, not only ours
+        self.resumes = {}   # path -> (offset, hash object) of checkpoint offered to remote
+        self.codec = self.readconfig("compress","codec","zlib")
+        self.level = int(self.readconfig("compress","level","6"))
+        self.codecs = weakref.WeakKeyDictionary()   # connect -> codec agreed with remote
+        self.metabytes = 0  # bytes of path info received from remote
+        self.compressstats = {"raw": 0, "wire": 0, "cpu": 0.0, "lock": threading.Lock()}
+        self.configlock = threading.Lock()
+        self.metrics = Metrics()
+        self.metricsport = int(self.readconfig("metrics","port","0"))  # local metrics endpoint, 0 is off
+        summary = self.readconfig("metrics","summary","metrics.json")   # JSON summary of last cycle
+        self.summaryfile = summary and os.path.join(os.path.dirname(os.path.abspath(self.configfile)), summary)
+        profile = self.readconfig("metrics","profile","")   # cProfile stats of each cycle
+        self.profilefile = profile and os.path.join(os.path.dirname(os.path.abspath(self.configfile)), profile)
+        self.profiler = None
+        self.tracetop = int(self.readconfig("metrics","tracemalloc","0"))  # top allocations reported, 0 is off
+        rate = int(self.readconfig("schedule","rate","0"))     # bytes/s out of windows, 0 is no limit
+        windows = self.parseWindows(self.readconfig("schedule","windows",""))
+        self.throttle = Throttle(rate, windows) if rate or windows else None
+        self.urgentsize = int(self.readconfig("schedule","urgentsize","1048576"))  # smaller recent files go first
+        self.urgentage = float(self.readconfig("schedule","urgentage","3600"))    # seconds a change is recent
+        self.diskslots = threading.BoundedSemaphore(int(self.readconfig("schedule","diskio","4")))
+        # "host:port" or "host:port=root" of peers the local folder is pushed to, root is remote by default
+        self.peers = [peer.strip() for peer in self.readconfig("peers","list","").split(",") if peer.strip()]
+        self.fanout = self.readconfig("peers","fanout","tree")   # star, chain or tree
+        self.degree = int(self.readconfig("peers","degree","2"))  # peers each node pushes to in tree
+        # "host:port" or "host" of any port a client may have this relay to, besides the peers of list
+        self.relays = [peer.strip() for peer in self.readconfig("peers","relay","").split(",") if peer.strip()]
+        # connects go by TLS if cert is set, both sides prove their cert is signed by ca
+        configdir = os.path.dirname(os.path.abspath(self.configfile))
+        cert, key, ca = [self.readconfig("tls",name,"") for name in ("cert","key","ca")]
+        files = cert and [name and os.path.join(configdir, name) for name in (cert, key, ca or cert)]
+        self.tlsname = self.readconfig("tls","name","")  # name in cert of server, not checked if empty
+        self.tlsclient = cert and self.makeContext(False, *files)
+        self.tlsserver = cert and self.makeContext(True, *files)
+        self.tlssessions = {}   # (host, port) -> TLS session of last connect, resumed by the next
         
         self.logger = self._getLogger()
 
 
     
     def _getLogger(self):
-        """create running log file,return logging instance."""
+        """create running log file,return logging instance.
+
+        Records are put on a queue and written to the file by a listener
+        thread, so logging never waits for the disk.
+        """
 
         logger = logging.getLogger('[FileSync]')
+        if logger.handlers:
+            return logger   # made by another instance
 
         #this_file = inspect.getfile(inspect.currentframe())
         #dirpath = os.path.abspath(os.path.dirname(this_file))
@@ -92,367 +292,2330 @@ class FileSync():
         formatter = logging.Formatter('%(asctime)s %(name)-8s %(levelname)-8s %(message)s')
         handler.setFormatter(formatter)
 
-        logger.addHandler(handler)
+        records = queue.SimpleQueue()
+        listener = logging.handlers.QueueListener(records, handler)
+        listener.start()
+        atexit.register(listener.stop)  # write the records left at exit
+        logger.addHandler(logging.handlers.QueueHandler(records))
         logger.setLevel(logging.INFO)
 
         return logger
     
-    def readconfig(self,section,name):
-        """Read config parameters from the file which name is config.ini."""
+    def readconfig(self,section,name,default=None):
+        """Read config parameters from the file which name is config.ini.
+
+        If default is given, it is returned when the parameter is not set.
+        """
 
         con = configparser.ConfigParser()
-        configfile = os.path.join(self.dirpath, "config.ini")
-        con.read(configfile, encoding="utf-8")
+        con.read(self.configfile, encoding="utf-8")
+        if default is not None and not con.has_option(section,name):
+            return default
         return con.get(section,name)
 
 
     def setconfig(self,section,name,value):
-        """Write config parameters to the file which name is config.ini."""
+        """Write config parameters to the file which name is config.ini.
+
+        The file is replaced at once, so a reader never sees it half written.
+        """
 
         con = configparser.ConfigParser()
-        configfile = os.path.join(self.dirpath, "config.ini")
-        con.read(configfile, encoding="utf-8")
+        con.read(self.configfile, encoding="utf-8")
         con.set(section, name, value)
-        with open(configfile,"w",encoding="utf-8") as f:
+        with open(self.configfile + ".tmp","w",encoding="utf-8") as f:
             con.write(f)
+        os.replace(self.configfile + ".tmp", self.configfile)
 
     
+    def parseWindows(self, text):
+        """Parse "HH:MM-HH:MM=rate, ..." of config, hours of one or two digits, return [(start minute, end minute, rate)]."""
+
+        windows = []
+        for item in text.split(","):
+            if not item.strip():
+                continue
+            try:
+                span, rate = item.split("=")
+                start, end = [self.parseMinute(t) for t in span.split("-")]
+                windows.append((start, end, int(rate)))
+            except ValueError:
+                raise ValueError("Bad window \"" + item.strip() + "\" in windows of [schedule], "
+                                 + "it should be like 9:00-18:00=1048576.") from None
+        return windows
+
+
+    def parseMinute(self, text):
+        """Parse "H:MM" or "HH:MM" of a day, return the minute of day."""
+
+        hour, minute = [int(t) for t in text.split(":")]
+        if not (0 <= hour <= 24 and 0 <= minute < 60 and hour * 60 + minute <= 1440):
+            raise ValueError("Time out of a day: " + text)
+        return hour * 60 + minute
+
+
+    def makeContext(self, server_side, cert, key, ca):
+        """Return a TLS context of server or client side.
+
+        The peer must show a cert signed by ca. One self-signed cert may be
+        shared by all hosts as cert and ca, it is then a pre-shared key.
+        """
+
+        if server_side:
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        else:
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+            context.check_hostname = bool(self.tlsname)
+        context.minimum_version = ssl.TLSVersion.TLSv1_2
+        context.verify_mode = ssl.CERT_REQUIRED
+        context.load_cert_chain(cert, key or None)
+        context.load_verify_locations(ca)
+        if self.throttle is not None:
+            context.sslsocket_class = ThrottledSSLSocket
+        return context
+
+
+    def wrapSocket(self, con, server_side=False):
+        """Return con secured by TLS of [tls] and paced by the throttle of [schedule].
+
+        con itself is returned if neither is set. A client resumes the TLS
+        session of its last connect to the same server, so only the first
+        connect pays a full handshake. A server does the handshake later,
+        in the thread serving the client.
+        """
+
+        if self.tlsclient:
+            if server_side:
+                con = self.tlsserver.wrap_socket(con, server_side=True, do_handshake_on_connect=False)
+            else:
+                con = self.tlsclient.wrap_socket(con, server_hostname=self.tlsname or None,
+                                                 session=self.tlssessions.get((self.serverip, self.port)))
+        elif self.throttle is not None:
+            timeout = con.gettimeout()
+            con = ThrottledSocket(con.family, con.type, con.proto, fileno=con.detach())
+            con.settimeout(timeout)
+        if self.throttle is not None:
+            con.throttle = self.throttle
+            con.local = self.local
+        return con
+
+
+    def getPriority(self, size, mtime):
+        """Return the priority of a file to transfer, 0 is urgent, 1 is small, 2 is bulk.
+
+        A file smaller than urgentsize changed in last urgentage seconds is
+        urgent, it is transferred first and never waits for the throttle.
+        """
+
+        if size < self.urgentsize and time.time() - mtime < self.urgentage:
+            return 0
+        if size < self.batchsize:
+            return 1
+        return 2
+
+
     def connect(self):
         """Make a socket connect, and return connect handle."""
 
         con = socket.socket(socket.AF_INET,socket.SOCK_STREAM)
+        con.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1) # frames go out back-to-back
         try:
             con.connect((self.serverip, self.port))
+            con = self.wrapSocket(con)
             msg = "Connect " + self.serverip + " success."
             print(msg)
             self.logger.info(msg)
+        except ssl.SSLError as e:
+            con.close()
+            msg = "Connect " + self.serverip + " failed in TLS handshake:" + str(e)
+            print(msg)
+            self.logger.error(msg)
+            return None
         except :
             msg = "Connect" + self.serverip + " failed, please check the network."
             print(msg)
             self.logger.error(msg)
             return None
+        if self.codec != "none" or isinstance(con, ssl.SSLSocket):
+            self.negotiate(con)     # a TLS 1.3 session ticket comes with the first answer
+        if isinstance(con, ssl.SSLSocket):
+            self.tlssessions[(self.serverip, self.port)] = con.session
+            self.metrics.add("tls_resumed" if con.session_reused else "tls_handshakes", 1)
         return con
 
 
+    def negotiate(self, con):
+        """Agree the codec of compression with remote, return the codec."""
+
+        codec = self.codec
+        if codec == "zstd" and zstandard is None:
+            msg = "Package zstandard is not installed, compress by zlib instead."
+            print(msg)
+            self.logger.warning(msg)
+            codec = "zlib"
+        self.sendMsg(con, self.MSG_CMD, self.CM_HELLO)
+        self.sendMsg(con, self.MSG_DATA, codec.encode())
+        type, recv = self.recvMsg(con)
+        codec = recv.decode()
+        if codec in self.CODECS:
+            self.codecs[con] = codec
+        msg = "Compress data on wire by " + codec
+        self.logger.info(msg)
+        return codec
+
+
+    def getCompressor(self, codec):
+        """Return a new compress object of codec."""
+
+        if codec == "zstd":
+            return zstandard.ZstdCompressor(level=self.level).compressobj()
+        if codec == "lzma":
+            return lzma.LZMACompressor(preset=self.level)
+        return zlib.compressobj(self.level)
+
+
+    def getDecompressor(self, id):
+        """Return a new decompress object of codec id."""
+
+        if id == self.CODECS["zstd"]:
+            return zstandard.ZstdDecompressor().decompressobj()
+        if id == self.CODECS["lzma"]:
+            return lzma.LZMADecompressor()
+        return zlib.decompressobj()
+
+
+    def compress(self, codec, data):
+        """Compress data at once by codec, return payload of a compressed frame."""
+
+        start = time.thread_time()
+        compressor = self.getCompressor(codec)
+        payload = bytes([self.CODECS[codec]]) + compressor.compress(data) + compressor.flush()
+        self.countCompress(len(data), len(payload), time.thread_time() - start)
+        return payload
+
+
+    def decompress(self, payload):
+        """Decompress payload of a compressed frame at once."""
+
+        start = time.thread_time()
+        data = self.getDecompressor(payload[0]).decompress(memoryview(payload)[1:])
+        self.countCompress(len(data), len(payload), time.thread_time() - start)
+        return data
+
+
+    def countCompress(self, raw, wire, cpu):
+        """Add bytes before and after compression and cpu seconds spent to the stats."""
+
+        stats = self.compressstats
+        with stats["lock"]:
+            stats["raw"] = stats["raw"] + raw
+            stats["wire"] = stats["wire"] + wire
+            stats["cpu"] = stats["cpu"] + cpu
+
+
+    def isCompressible(self, path, sample):
+        """Tell if a file is worth compressing, by its extension and a sample of it.
+
+        A sample whose byte entropy is near 8 bits looks compressed already.
+        """
+
+        if os.path.splitext(path)[1].lower() in self.PACKED or len(sample) < 512:
+            return False
+        counts = collections.Counter(sample)
+        total = len(sample)
+        entropy = -sum(n / total * math.log2(n / total) for n in counts.values())
+        return entropy < 7.5
+
+
+    def sendContent(self, con, fp, size, path):
+        """Send size bytes of an opened file, compressed if remote agreed a codec.
+
+        Return bytes on wire.
+        """
+
+        codec = self.codecs.get(con)
+        if codec:
+            pos = fp.tell()
+            sample = fp.read(65536)
+            fp.seek(pos)
+            if self.isCompressible(path, sample):
+                return self.sendCompressed(con, fp, size, codec)
+        return self.FRAME_HEAD.size + self.sendStream(con, fp, size)
+
+
+    def sendCompressed(self, con, fp, size, codec):
+        """Send size bytes of an opened file as MSG_ZDATA frames, return bytes on wire."""
+
+        id = bytes([self.CODECS[codec]])
+        compressor = self.getCompressor(codec)
+        wire = 0
+        cpu = 0.0
+        left = size
+        while True:
+            with self.diskslots:
+                chunk = fp.read(min(left, self.chunksize))
+            left = left - len(chunk)
+            start = time.thread_time()
+            data = compressor.compress(chunk) if chunk else compressor.flush()
+            cpu = cpu + time.thread_time() - start
+            if data:
+                self.sendMsg(con, self.MSG_ZDATA, id + data)
+                wire = wire + self.FRAME_HEAD.size + 1 + len(data)
+            if not chunk:
+                break
+        if left > 0:    # the frames can't be finished, drop the connect
+            raise ConnectionError("File is truncated while sending.")
+        self.sendMsg(con, self.MSG_CMD, self.CM_SEND_OVER)
+        wire = wire + self.FRAME_HEAD.size + len(self.CM_SEND_OVER)
+        self.countCompress(size, wire, cpu)
+        return wire
+
+
+    def recvCompressed(self, con, fp, type, length):
+        """Receive MSG_ZDATA frames and write the content to an opened file.
+
+        type and length are the head of the first frame, which is read.
+        Return (bytes on wire, size of file).
+        """
+
+        decompressor = None
+        wire = 0
+        size = 0
+        cpu = 0.0
+        while type == self.MSG_ZDATA:
+            payload = self.recvExact(con, length)
+            wire = wire + self.FRAME_HEAD.size + length
+            start = time.thread_time()
+            if decompressor is None:
+                decompressor = self.getDecompressor(payload[0])
+            data = decompressor.decompress(memoryview(payload)[1:])
+            cpu = cpu + time.thread_time() - start
+            with self.diskslots:
+                fp.write(data)
+            size = size + len(data)
+            type, length = self.recvHead(con)
+        self.recvExact(con, length)    # end of content
+        wire = wire + self.FRAME_HEAD.size + length
+        self.countCompress(size, wire, cpu)
+        return wire, size
+
+
+    def reportCompress(self):
+        """Report bytes compressed and decompressed, the ratio and cpu time spent."""
+
+        stats = self.compressstats
+        with stats["lock"]:
+            ratio = stats["raw"] / stats["wire"] if stats["wire"] else 1.0
+            msg = ("Compress " + str(stats["raw"]) + " bytes to " + str(stats["wire"])
+                   + " bytes on wire, ratio %.2f, cpu %.3fs" % (ratio, stats["cpu"]))
+        print(msg)
+        self.logger.info(msg)
+        return stats
+
+
+    def getBuffer(self):
+        """Return the receive buffer of this thread, allocated once."""
+
+        buffer = getattr(self.local, "buffer", None)
+        if buffer is None:
+            buffer = self.local.buffer = bytearray(self.chunksize)
+        return buffer
+
+
+    def sendMsg(self, con, type, payload=b""):
+        """Send one frame of given type to remote."""
+
+        con.sendall(self.FRAME_HEAD.pack(type, len(payload)) + payload)
+
+
+    def recvExact(self, con, size):
+        """Receive exactly size bytes, raise ConnectionError if remote closed."""
+
+        data = bytearray(size)
+        view = memoryview(data)
+        recvsize = 0
+        while recvsize < size:
+            n = con.recv_into(view[recvsize:])
+            if n == 0:
+                raise ConnectionError("Connect closed by remote.")
+            recvsize = recvsize + n
+        return bytes(data)
+
+
+    def recvHead(self, con):
+        """Receive head of the next frame, return (type, length)."""
+
+        return self.FRAME_HEAD.unpack(self.recvExact(con, self.FRAME_HEAD.size))
+
+
+    def recvMsg(self, con):
+        """Receive the next frame, return (type, payload)."""
+
+        type, length = self.recvHead(con)
+        return type, self.recvExact(con, length)
+
+
+    def sendStream(self, con, fp, size):
+        """Send size bytes of an opened file from its position as one MSG_DATA frame.
+
+        The content goes by os.sendfile where the system has it and the
+        connect is neither throttled nor TLS, otherwise by chunks of
+        chunksize read into one buffer and sent from it, so memory use does
+        not grow with file size. Either way each chunksize read from disk
+        takes a slot of diskio.
+        """
+
+        con.sendall(self.FRAME_HEAD.pack(self.MSG_DATA, size))
+        if size == 0:
+            sent = 0
+        elif hasattr(os, "sendfile") and not isinstance(con, (ThrottledSocket, ssl.SSLSocket)):
+            offset = fp.tell()
+            sent = 0
+            while sent < size:  # a disk slot is held for one chunk at a time
+                with self.diskslots:
+                    n = con.sendfile(fp, offset + sent, min(size - sent, self.chunksize))
+                if n == 0:
+                    break
+                sent = sent + n
+        else:
+            view = memoryview(bytearray(self.chunksize))
+            sent = 0
+            while sent < size:
+                with self.diskslots:
+                    n = fp.readinto(view[:min(size - sent, self.chunksize)])
+                if n == 0:
+                    break
+                con.sendall(view[:n])
+                sent = sent + n
+        if sent < size:     # the frame can't be finished, drop the connect
+            raise ConnectionError("File is truncated while sending.")
+        return sent
+
+
+    def recvStream(self, con, fp, size):
+        """Receive size bytes of frame payload and write them to an opened file.
+
+        Data is received into the preallocated buffer, which is written out
+        each time it is full.
+        """
+
+        view = memoryview(self.getBuffer())
+        recvsize = 0
+        while recvsize < size:
+            want = min(size - recvsize, len(view))
+            filled = 0
+            while filled < want:
+                n = con.recv_into(view[filled:want])
+                if n == 0:
+                    raise ConnectionError("Connect closed by remote.")
+                filled = filled + n
+            with self.diskslots:
+                fp.write(view[:filled])
+            recvsize = recvsize + filled
+        return recvsize
+
+
     def getRemoteFolder(self, con,remotepath,synctime=0):
-        """Get details of directory on remote computer,return lists of path info."""
+        """Get details of directory on remote computer, return a Listing."""
 
         msg = "Getting the details of remote directory " + remotepath
         self.logger.info(msg)
-        folderlist = []
+        folderlist = Listing()
         try:
-            con.sendall(self.CM_FETCH_DIR)  
-            while True:
-                recv = con.recv(128)
-                if recv == self.CM_FETCH_TIME: #send last sync time
-                    con.sendall(synctime.to_bytes(4,byteorder="little"))
-                    break
-            while True:
-                recv = con.recv(1024)
-                if recv:
-                    if recv == self.CM_SEND_OVER:
-                        msg = "End the transform. "
-                        break   #end sync folder list
-                    else:
-                        folderlist.append(recv.decode())
+            self.sendMsg(con, self.MSG_CMD, self.CM_FETCH_DIR)
+            self.sendMsg(con, self.MSG_DATA, synctime.to_bytes(8,byteorder="little"))  #send last sync time
+            folderlist = self.recvListing(con)
             msg = "Receive " + str(len(folderlist)) + " directory info."
         except Exception as e:
-            msg = "Get the remote directory failed:" + e.args
+            msg = "Get the remote directory failed:" + str(e)
         print(msg)  
         self.logger.info(msg)
         return folderlist
     
 
-    def getFolder(self, folder,synctime=0):
-        """Get details of directory on local computer,return lists of path info"""
+    def recvList(self, con):
+        """Receive MSG_LIST or MSG_ZLIST frames until send over, return the records."""
 
-        msg = "Getting the details of remote directory:" + folder
+        records = []
+        while True:
+            type, recv = self.recvMsg(con)
+            self.metabytes = self.metabytes + self.FRAME_HEAD.size + len(recv)
+            if type == self.MSG_CMD and recv == self.CM_SEND_OVER:
+                break   #end sync folder list
+            if type == self.MSG_ZLIST:
+                type, recv = self.MSG_LIST, self.decompress(recv)
+            if type == self.MSG_LIST:
+                records.extend(recv.decode().split("\0"))
+        return records
+
+
+    def recvListing(self, con):
+        """Receive MSG_ITEMS or MSG_ZITEMS frames until send over, return the Listing."""
+
+        listing = Listing()
+        while True:
+            type, recv = self.recvMsg(con)
+            self.metabytes = self.metabytes + self.FRAME_HEAD.size + len(recv)
+            if type == self.MSG_CMD and recv == self.CM_SEND_OVER:
+                break
+            if type == self.MSG_ZITEMS:
+                type, recv = self.MSG_ITEMS, self.decompress(recv)
+            if type == self.MSG_ITEMS:
+                listing.unpack(recv)
+        return listing
+
+
+    def getTreeFolders(self, con):
+        """Walk the directory digests of both sides top-down, return (local, remote) path info.
+
+        Only the children of directories whose digests differ are listed,
+        one round trip for each level of the tree. What is returned gives
+        same difference items to getDiff as the full listings do.
+        """
+
+        msg = "Compare directory digests with remote " + self.remotepath
         self.logger.info(msg)
-        folderlist = []
-        for root,subs,files in os.walk(folder):
-            foldersize = os.path.getsize(root)
-            foldertime = int(os.path.getmtime(root))
-            if foldertime > synctime:
-                folderinfo = root + ",d," + str(foldersize) + "," + str(foldertime)
-                folderlist.append(folderinfo)
-            for file in files:
-                path = root + "\\" + file
-                filesize = os.path.getsize(path)
-                filetime = int(os.path.getmtime(path))
-                if filetime > synctime:
-                    fileinfo = path + ",f," + str(filesize) + "," + str(filetime)
-                    folderlist.append(fileinfo)
-        msg = "Find " + str(len(folderlist)) + " path info."
+        self.updateTree(self.localpath)
+        localfolder = []
+        remotefolder = []
+        pending = [""]  # relative path of directories on both sides to compare
+        remoteonly = []
+        rounds = 0
+        while pending or remoteonly:
+            dirs = [self.mapPath(os.path.join(self.localpath, rel) if rel else self.localpath,
+                                 self.localpath, self.remotepath) for rel in pending + remoteonly]
+            self.sendMsg(con, self.MSG_CMD, self.CM_FETCH_TREE)
+            self.sendMsg(con, self.MSG_LIST, "\0".join(dirs).encode())
+            remote = {}
+            for rec in self.recvList(con):
+                if rec:
+                    digest, info = rec.split(",", 1)
+                    remote[self.parseInfo(info, self.remotepath)[0]] = (digest or info.rsplit(",", 3)[1:], info)
+            rounds = rounds + 1
+            local = {}
+            for rec in self.listTree([os.path.join(self.localpath, rel) if rel else self.localpath
+                                      for rel in pending]):
+                digest, info = rec.split(",", 1)
+                local[self.parseInfo(info, self.localpath)[0]] = (digest or info.rsplit(",", 3)[1:], info)
+            if rounds == 1 and "" in local and "" in remote and local[""][0] == remote[""][0]:
+                break   # same tree
+            for rel in pending + remoteonly:
+                local.pop(rel, None)
+                remote.pop(rel, None)
+            remoteonly = []
+            pending = []
+            for rel, (digest, info) in remote.items():
+                same = local.pop(rel, None)
+                if same is not None and same[0] == digest:
+                    continue    # same file or same subtree
+                remotefolder.append(info)
+                isdir = info.rsplit(",", 3)[1] == "d"
+                if same is not None:
+                    localfolder.append(same[1])
+                    path, type = same[1].rsplit(",", 3)[:2]
+                    if type == "d" and isdir:
+                        pending.append(rel)
+                        continue
+                    if type == "d":
+                        localfolder.extend(self.listSubtree(path))
+                if isdir:
+                    remoteonly.append(rel)
+            for rel, (digest, info) in local.items():
+                localfolder.append(info)
+                path, type = info.rsplit(",", 3)[:2]
+                if type == "d":
+                    localfolder.extend(self.listSubtree(path))
+        msg = ("Compare directory digests in " + str(rounds) + " round trips, "
+               + str(len(localfolder)) + " local and " + str(len(remotefolder)) + " remote path info.")
         print(msg)
         self.logger.info(msg)
-        return folderlist
-    
+        return localfolder, remotefolder
 
-    def getDiff(self,local,remote):
-        """Compare the difference of two directory, and return the difference items."""
 
-        diff = []
-        for localinfo in local:
-            localdetail = localinfo.split(",")
-            localfiletime = int(localdetail[3])
-            findsame = ""
-            for remoteinfo in remote:
-                remotedetail = remoteinfo.split(",")
-                remotefiletime = int(remotedetail[3])
-
-                # have the same name
-                if (localdetail[0] == remotedetail[0]):
-                    findsame = remoteinfo   
-                    # if type is directory
-                    if localdetail[1] == "d":
-                        findsame = remoteinfo
-                        break
-                    # if have same size
-                    if localdetail[2] == remotedetail[2]:
-                        findsame = remoteinfo
-                        break
-                    else:
-                        if (remotefiletime-localfiletime) > 3 :   
-                            diff.append((remoteinfo,"new in remote"))  
-
-                        if (localfiletime-remotefiletime) > 3:  
-                            diff.append((localinfo,"new in local"))     
-                        
-            if findsame: 
-                remote.remove(findsame)  #delete same item, reduce running time.
-            else:       
-                diff.append((localinfo,"only in local"))    
-        for info in remote:
-            diff.append((info,"only in remote"))  
-        msg = "Find " + str(len(diff)) + " difference items."
-        print(msg)
-        self.logger.info(msg)
-        return diff
-    
+    def getIndex(self):
+        """Open the manifest index database, return the connect."""
 
-    def sendFile(self,con,filepath):
-        """Send file to remote. If not success, return -1."""
+        if self.index is None:
+            db = sqlite3.connect(self.indexfile, timeout=60, check_same_thread=False)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            # hash is the content hash of a file, or the digest of a directory
+            db.execute("CREATE TABLE IF NOT EXISTS entry (path TEXT PRIMARY KEY, parent TEXT, "
+                       "type TEXT, size INTEGER, mtime_ns INTEGER, inode INTEGER, hash BLOB)")
+            db.execute("CREATE INDEX IF NOT EXISTS entry_parent ON entry (parent)")
+            db.execute("CREATE INDEX IF NOT EXISTS entry_size ON entry (size)")
+            db.commit()
+            self.index = db
+        return self.index
 
-        status = 0
-        if os.path.exists(filepath):
-            msg = "Find the" + filepath +"and sending file to remote."
-            self.logger.info(msg)
-            fp = open(filepath,'rb')
-            data = fp.read()
-            con.sendall(data)
-            msg = "End send file:" + filepath + ",total size is " + str(len(data)) 
-        else:
-            msg = "Can't find the" + filepath +",please check file name is correct."
-            status = -1
-        print(msg)
-        self.logger.info(msg)
-        return status
 
+    def getPrefix(self, folder):
+        """Return (lower, upper) bound of the paths under folder in the index."""
 
-    def recvFile(self, con, filepath):
-        """Receive a file and save it to specific directory."""
+        prefix = folder if folder.endswith(os.sep) else folder + os.sep
+        return prefix, prefix[:-1] + chr(ord(os.sep) + 1)
 
-        fileinfo = filepath.split(",")
-        filename = fileinfo[0]
-        filesize = int(fileinfo[2])
-        msg = "Receiving file which name is " + filename + "size:" + str(filesize)
-        self.logger.info(msg)
 
-        if os.path.exists(filename):    #if have same file,bankup local file.
-            self.bankupFile(filename)   
-            self.logger.info("Bankup old file what's name is same.")
+    def updateIndex(self, folder, listing=None, changes=None):
+        """Bring the manifest index of folder up to date, return count of changed entries.
 
-        file = open(filename,"wb")
-        recvsize = 0
-        while recvsize < filesize:
-            if (filesize - recvsize) > 1024:
-                recv = con.recv(1024)
-            else:
-                recv = con.recv(filesize-recvsize)
-            recvsize = recvsize + len(recv)
-            file.write(recv)
+        If listing is given, (path, type, size, mtime_ns) of every entry in
+        the index is appended to it. If changes is given, path of every
+        changed or removed entry is appended to it.
+        """
 
-        msg = "End receive file " + filename
-        self.logger.info(msg)
-        file.close()
-        return recvsize
+        found = [] if changes is None else changes
+        start = len(found)
+        for row in self.scanIndex(folder, found):
+            if listing is not None:
+                listing.append(row)
+        return len(found) - start
+
+
+    def scanIndex(self, folder, changes):
+        """Bring the manifest index of folder up to date, yield (path, type, size, mtime_ns) of every entry.
+
+        Directories are read and entries are stat by a pool of scanners
+        threads, SCAN_BATCH entries a task, so the waits on a slow network
+        mount overlap. Every entry is stat once, by the cached stat of
+        os.scandir. A directory whose mtime is same as in the index still
+        has the same names, so it is not read again and only its known
+        entries are stat, because a file written in place does not change
+        the mtime of its directory. With [index] trust, the index rows of
+        files in such a directory are taken as they are and only its
+        subdirectories are stat, so a file written in place without
+        touching its directory is missed until the directory changes. Path
+        of every changed or removed entry is appended to changes.
+        """
+
+        db = self.getIndex()
+        changed = []
+        removed = []
+        with self.indexlock:
+            root = db.execute("SELECT type,size,mtime_ns,inode FROM entry WHERE path=?",
+                              (folder,)).fetchone()
+        st = os.stat(folder)
+        stack = [(folder, st, st.st_ino, root)]
+        pending = collections.deque()   # (future, known entries of dir, is it a listing)
+        pool = concurrent.futures.ThreadPoolExecutor(self.scanners)
+        try:
+            while stack or pending:
+                while stack and len(pending) < self.scanners * 2:
+                    dir, st, inode, old = stack.pop()
+                    new = ("d", st.st_size, st.st_mtime_ns, inode)
+                    if old != new:
+                        changed.append((dir, os.path.dirname(dir)) + new)
+                    yield (dir,) + new[:3]
+                    with self.indexlock:
+                        known = {}
+                        for row in db.execute("SELECT path,type,size,mtime_ns,inode FROM entry WHERE parent=?",
+                                              (dir,)):
+                            known[row[0]] = row[1:]
+                    if old is not None and old[2] == st.st_mtime_ns:    # same names as last time
+                        if self.indextrust:
+                            paths = [path for path, row in known.items() if row[0] == "d"]
+                            for path, row in known.items():
+                                if row[0] != "d":
+                                    yield (path,) + row[:3]
+                        else:
+                            paths = list(known)
+                        for i in range(0, len(paths), self.SCAN_BATCH):
+                            pending.append((pool.submit(self.statEntries, paths[i:i + self.SCAN_BATCH]), known, False))
+                    else:
+                        pending.append((pool.submit(self.listDir, dir), known, True))
+                if not pending:
+                    continue
+                future, known, listing = pending.popleft()
+                if listing:
+                    entries = future.result()
+                    names = set(entry.path for entry in entries)
+                    removed.extend(path for path in known if path not in names)
+                    for i in range(0, len(entries), self.SCAN_BATCH):
+                        pending.append((pool.submit(self.statEntries, entries[i:i + self.SCAN_BATCH]), known, False))
+                    continue
+                found, gone = future.result()
+                removed.extend(path for path in gone if path in known)
+                for path, isdir, st, inode in found:
+                    if isdir:
+                        stack.append((path, st, inode, known.get(path)))
+                        continue
+                    new = ("f", st.st_size, st.st_mtime_ns, inode)
+                    if known.get(path) != new:
+                        changed.append((path, os.path.dirname(path)) + new)
+                    yield (path,) + new[:3]
+                if len(changed) + len(removed) >= 10000:
+                    with self.indexlock:
+                        self._writeIndex(db, changed, removed, changes)
+        finally:
+            pool.shutdown(cancel_futures=True)
+        with self.indexlock:
+            self._writeIndex(db, changed, removed, changes)
+
+
+    def listDir(self, dir):
+        """Return DirEntry of the entries of dir for scanIndex.
+
+        Symlinked directories and files being received are left out, and a
+        directory gone meanwhile has no entries.
+        """
 
+        entries = []
+        try:
+            with os.scandir(dir) as it:
+                for entry in it:
+                    if entry.name.endswith(self.TRANSIENT):
+                        continue    # being received, not synced
+                    try:
+                        if entry.is_dir() and entry.is_symlink():
+                            continue    # os.walk did not follow it either
+                    except OSError:
+                        continue
+                    entries.append(entry)
+        except OSError:
+            pass
+        return entries
 
-    def recvDir(self,dir):
-        """Receive remote directory and create on local computer."""
 
-        if os.path.exists(dir):
-            msg = "The local computer has same directory:" + dir
-            print(msg)
-            self.logger.info(msg)
-            return -1
-        else:
-            os.mkdir(dir)
-            msg = "Make the new directory " + dir
-            print(msg)
-            self.logger.info(msg)
-            return 0
+    def statEntries(self, entries):
+        """Stat a batch of DirEntry or paths for scanIndex, return (found, gone).
 
+        found is (path, is directory, stat, inode) of each entry, gone is
+        path of each entry which can't be stat any more.
+        """
 
-    def getRemoteFile(self,con, path):
-        """Get the remote directory or file and save to local."""
+        found = []
+        gone = []
+        for entry in entries:
+            try:
+                if isinstance(entry, str):
+                    st = os.stat(entry)
+                    found.append((entry, stat.S_ISDIR(st.st_mode), st, st.st_ino))
+                else:
+                    found.append((entry.path, entry.is_dir(), entry.stat(), entry.inode()))
+            except OSError:
+                gone.append(entry if isinstance(entry, str) else entry.path)
+        return found, gone
+
+
+    def _writeIndex(self, db, changed, removed, changes=None):
+        """Write changed rows to index and delete removed paths, return the count."""
+
+        count = len(changed) + len(removed)
+        if changes is not None:
+            changes.extend(row[0] for row in changed)
+            changes.extend(removed)
+        db.executemany("INSERT OR REPLACE INTO entry VALUES (?,?,?,?,?,?,NULL)", changed)
+        for path in removed:
+            lower, upper = self.getPrefix(path)
+            db.execute("DELETE FROM entry WHERE path=? OR (path>=? AND path<?)", (path, lower, upper))
+        self._dropDigest(db, [row[1] for row in changed] + [os.path.dirname(path) for path in removed])
+        db.commit()
+        changed.clear()
+        removed.clear()
+        return count
+
+
+    def _dropDigest(self, db, dirs):
+        """Clear the digests of dirs and all their parents in index."""
+
+        dropped = set()
+        for dir in dirs:
+            while dir not in dropped:
+                dropped.add(dir)
+                parent = os.path.dirname(dir)
+                if parent == dir:
+                    break
+                dir = parent
+        db.executemany("UPDATE entry SET hash=NULL WHERE path=? AND type='d'", [(dir,) for dir in dropped])
 
-        filepath = path.split(",")[0]
-        msg = "Getting remote file:" + filepath
-        print(msg)
-        self.logger.info(msg)
-        type = path.split(",")[1]
-        if type == "d": # directory
-            if os.path.exists(filepath):
-                msg = "Local computer has same directory:" + filepath
+
+    def updateTree(self, folder):
+        """Bring the index of folder and the digests of directories under it up to date.
+
+        Only directories whose digest was cleared by a change under them are
+        digested again. Return the digest of folder.
+        """
+
+        self.updateIndex(folder)
+        db = self.getIndex()
+        with self.indexlock:
+            digest = self._digestDir(db, folder)
+            db.commit()
+        return digest
+
+
+    def _digestDir(self, db, dir):
+        """Return the digest of dir in index, make it first if it is cleared.
+
+        The digest covers name, size and mtime of every file in dir, and
+        name and digest of every sub directory.
+        """
+
+        row = db.execute("SELECT hash FROM entry WHERE path=?", (dir,)).fetchone()
+        if row is None or row[0]:
+            return row and row[0]
+        children = db.execute("SELECT path,type,size,mtime_ns,hash FROM entry WHERE parent=?", (dir,)).fetchall()
+        h = hashlib.blake2b(digest_size=16)
+        for path, type, size, mtime, digest in sorted(children, key=lambda row: os.path.basename(row[0])):
+            name = os.path.basename(path)
+            if type == "d":
+                h.update((name + "\0d\0").encode() + (digest or self._digestDir(db, path)))
             else:
-                msg = "Create new directory:" + filepath
-                os.mkdir(filepath)  
-            print(msg)
-            self.logger.info(msg)
-        else:   # file
-            con.sendall(self.CM_FETCH_FILE)
-            recv = con.recv(128)
-            if recv == self.CM_FETCH_NAME:
-                con.sendall(filepath.encode())  # send file name
-            filesize = int(path.split(",")[2])
-            
-            # bankup file which has same name in local
-            if os.path.exists(filepath):
-                msg = "Local computer has same name file, bankup the file:" + filepath
-                print(msg)
-                self.logger.info(msg)
-                self.bankupFile(filepath)
+                h.update((name + "\0f\0" + str(size) + "\0" + str(mtime // 1000000000) + "\0").encode())
+        digest = h.digest()
+        db.execute("UPDATE entry SET hash=? WHERE path=?", (digest, dir))
+        return digest
 
-            file = open(filepath,"wb")
-            recvsize = 0
-            while recvsize < filesize:
-                if (filesize - recvsize) > 1024:
-                    recv = con.recv(1024)
-                else:
-                    recv = con.recv(filesize-recvsize)
-                recvsize = recvsize + len(recv)
-                file.write(recv)
-            file.close()
-            msg = "End receive and save file:" + filepath
-            print(msg)
-            self.logger.info(msg)
-        return 0
-    
-    def bankupFile(self, path):
-        """Rename file and bankup a copy and bankup time."""
-
-        filepath = path.split(",")[0]   
-        dir = os.path.dirname(filepath) 
-        if os.access(filepath,os.F_OK):
-            basename = os.path.basename(filepath)   # get file name with suffix
-            filename = os.path.splitext(basename)   # get file name
-            name = filename[0]
-            ext = filename[1]
-            t = time.strftime("%Y%m%d%H%M",time.localtime())
-            newname = name + t + ext 
-            newfilepath = os.path.join(dir,newname)
-            os.rename(filepath,newfilepath)
-            msg = "File: "+ filepath + " is bankup to " + newfilepath
-            print(msg)
-            self.logger.info(msg)            
-        else:
-            msg = "File: "+ filepath + " is locked by other programm. bankup fail."
-            print(msg)
-            self.logger.info(msg)
 
+    def listTree(self, dirs):
+        """Return path info of dirs and their children from index, each led by a digest.
 
-    def updateRemote(self,con, path):
-        """Push local directory or file to remote."""
-        pathlist = path.split(",")
-        if pathlist[1] == "d":
-            con.sendall(self.CM_PUSH_DIR)
+        A record is "digest,path,type,size,mtime", digest is empty for files,
+        which are compared by type, size and mtime.
+        A directory not in index is left out.
+        """
+
+        db = self.getIndex()
+        records = []
+        with self.indexlock:
+            for dir in dirs:
+                row = db.execute("SELECT path,type,size,mtime_ns,hash FROM entry WHERE path=?", (dir,)).fetchone()
+                if row is None:
+                    continue
+                rows = [row] + db.execute("SELECT path,type,size,mtime_ns,hash FROM entry WHERE parent=?",
+                                          (dir,)).fetchall()
+                for path, type, size, mtime, digest in rows:
+                    digest = digest.hex() if type == "d" and digest else ""
+                    records.append(digest + "," + path + "," + type + "," + str(size) + "," + str(mtime // 1000000000))
+        return records
+
+
+    def listSubtree(self, folder):
+        """Return path info of everything under folder from index."""
+
+        lower, upper = self.getPrefix(folder)
+        db = self.getIndex()
+        with self.indexlock:
+            rows = db.execute("SELECT path,type,size,mtime_ns FROM entry WHERE path>=? AND path<?",
+                              (lower, upper)).fetchall()
+        return [path + "," + type + "," + str(size) + "," + str(mtime // 1000000000)
+                for path, type, size, mtime in rows]
+
+
+    def getHash(self, path):
+        """Return blake2b hash of a local file, cached in the manifest index."""
+
+        st = os.stat(path)
+        db = self.getIndex()
+        with self.indexlock:
+            row = db.execute("SELECT size,mtime_ns,inode,hash FROM entry WHERE path=?", (path,)).fetchone()
+        if row and row[3] and row[0] == st.st_size and row[1] == st.st_mtime_ns:
+            return row[3]
+        h = hashlib.blake2b(digest_size=16)
+        view = memoryview(bytearray(self.chunksize))
+        with open(path, "rb") as fp:
             while True:
-                recv = con.recv(128)
-                if recv == self.CM_FETCH_NAME:
-                    con.sendall(pathlist[0].encode())
+                with self.diskslots:
+                    n = fp.readinto(view)
+                if n == 0:
                     break
-            msg = "Send local directory to remote:"+ pathlist[0]    
+                h.update(view[:n])
+        digest = h.digest()
+        with self.indexlock:
+            db.execute("INSERT OR REPLACE INTO entry VALUES (?,?,?,?,?,?,?)",
+                       (path, os.path.dirname(path), "f", st.st_size, st.st_mtime_ns, st.st_ino, digest))
+            if not row or row[0] != st.st_size or row[1] != st.st_mtime_ns:
+                self._dropDigest(db, [os.path.dirname(path)])
+            db.commit()
+        return digest
 
-        if pathlist[1] == "f":
-            con.sendall(self.CM_PUSH_FILE)
-            while True:
-                recv = con.recv(128)
-                if recv == self.CM_FETCH_NAME:
-                    con.sendall(path.encode())
-                    break               
-            fp = open(pathlist[0],"rb")
-            con.sendall(fp.read())
-            msg = "Send local file to remote:"+ pathlist[0]
+
+    def getFolder(self, folder,synctime=0):
+        """Get details of directory on local computer, return a Listing.
+
+        Entries go into the Listing while the manifest index is brought up
+        to date, so no string of path info is built for them.
+        """
+
+        msg = "Getting the details of remote directory:" + folder
+        self.logger.info(msg)
+        changes = []
+        listing = Listing()
+        since = (synctime + 1) * 1000000000
+        for path, type, size, mtime in self.scanIndex(folder, changes):
+            if mtime >= since:
+                listing.append(path[len(folder):].replace(os.sep, "/").strip("/"),
+                               type, size, mtime // 1000000000)
+        msg = "Find " + str(len(listing)) + " path info, " + str(len(changes)) + " changed in index."
         print(msg)
         self.logger.info(msg)
-        return 0
+        return listing
     
-    def sendFolder(self,con,folder,synctime=0):
-        """Send details of directory to remote."""
 
-        for rec in folder:
-            con.sendall(rec.encode())
-            time.sleep(0.1)
-        con.sendall(self.CM_SEND_OVER)
+    def parseInfo(self, info, root=""):
+        """Split a path info record, return (relative path, type, size, mtime)."""
 
-        msg = "Send " + str(len(folder)) + "to remote."
-        print(msg)
-        self.logger.info(msg)
+        path, type, size, mtime = info.rsplit(",", 3)   # path may contain ","
+        if root and path.startswith(root):
+            path = path[len(root):]
+        path = path.replace("\\", "/").strip("/")
+        return path, type, int(size), int(mtime)
 
 
-    def startSync(self):
-        """Compare local directory to the remote directory,
-        then push new local file to remote, and get new file in remote.
+    def mapPath(self, path, fromroot, toroot):
+        """Return the path at the same relative place under toroot as path under fromroot.
+
+        The separator of toroot is kept, so a local path can be mapped onto
+        a remote computer of other system.
         """
-        while self.needsync:
-            msg = "Starting file sync between " + self.clientip + " and " + self.serverip
-            print(msg)
-            self.logger.info(msg)
-            con = self.connect()           
-            localfolder = []
-            remotefolder = []    
 
-            now = int(time.time())
-            if self.synctime == "" : 
-                lastsync = 0
-                msg = "First time sync, start full sync."
-            else:
-                msg = "The last sync time is:" + self.synctime
-                lastsync = time.strptime(self.synctime,"%Y-%m-%d %H:%M:%S")
-                lastsync = int(time.mktime(lastsync))
-            print(msg)
-            self.logger.info(msg)
+        if fromroot == toroot or not path.startswith(fromroot):
+            return path
+        rel = path[len(fromroot):]
+        if rel and rel[0] not in "\\/" and not fromroot.endswith(("\\", "/")):
+            return path     # only a name starts like fromroot
+        return self.joinPath(toroot, rel.replace("\\", "/").strip("/"))
 
-            if now > lastsync:
-                localfolder = self.getFolder(self.localpath,lastsync)               
-                remotefolder = self.getRemoteFolder(con,self.remotepath,lastsync)
-                msg = "Get the local and remote directory info." 
-                print(msg)
-                self.logger.info(msg)
-            else:
-                msg ="Now is not the scheduled sync time:" + self.synctime + "end sync."
-                print(msg)
-                self.logger.info(msg)
-                break
 
-            #compare difference        
-            diff = self.getDiff(localfolder,remotefolder)
+    def joinPath(self, root, rel):
+        """Return relative path rel under root, with the separator of root."""
 
-            if diff:
-                msg = "Start deal diff directory|file one by one."
-                for i in diff:
-                    if (i[1] == "new in remote") or i[1] == "only in remote":
-                        self.getRemoteFile(con, i[0])
-                    if (i[1] == "new in local") or (i[1] == "only in local"):
-                        self.updateRemote(con, i[0])
-            else:
-                msg = "No difference found after last sync, end sync."
+        if not rel:
+            return root
+        sep = "\\" if "\\" in root else "/" if "/" in root else os.sep
+        return root.rstrip(sep) + sep + rel.replace("/", sep)
+
+
+    def toListing(self, folder, root):
+        """Return folder as a Listing, folder is a Listing or path info under root."""
+
+        if isinstance(folder, Listing):
+            return folder
+        listing = Listing()
+        for info in folder:
+            listing.append(*self.parseInfo(info, root))
+        return listing
+
+
+    def makeInfo(self, listing, i, offsets, root):
+        """Return the path info of entry i of listing under root."""
+
+        return (self.joinPath(root, listing.path(i, offsets)) + "," + chr(listing.types[i])
+                + "," + str(listing.sizes[i]) + "," + str(listing.mtimes[i]))
+
+
+    def getDiff(self,local,remote,localroot=None,remoteroot=None):
+        """Compare the difference of two directory, and return the difference items.
+
+        local and remote are Listings, or path info. They are compared one
+        directory at a time, by names of the entries in it, so the compare
+        runs in linear time and path info is made only for the items.
+        """
+
+        if localroot is None:
+            localroot = self.localpath
+        if remoteroot is None:
+            remoteroot = self.remotepath
+        local = self.toListing(local, localroot)
+        remote = self.toListing(remote, remoteroot)
+
+        localoffsets = local.offsets()
+        remoteoffsets = remote.offsets()
+        localnames = bytes(local.names)
+        remotenames = bytes(remote.names)
+        remotegroups = remote.groups()
+        matched = bytearray(len(remote))    # matched item is out of the compare
+        diff = []
+        # parents go before children, so directories are made in order
+        for dir, ids in sorted(zip(local.dirs, local.groups()), key=lambda group: group[0]):
+            names = {}
+            if dir in remote.dirids:
+                names = {remotenames[remoteoffsets[j]:remoteoffsets[j + 1]]: j
+                         for j in remotegroups[remote.dirids[dir]]}
+            for i in ids:
+                j = names.get(localnames[localoffsets[i]:localoffsets[i + 1]])
+                if j is None:
+                    diff.append((self.makeInfo(local, i, localoffsets, localroot),"only in local"))
+                    continue
+                matched[j] = 1
+                # directory or file have same size
+                if local.types[i] == ord("d") or local.sizes[i] == remote.sizes[j]:
+                    continue
+                localfiletime = local.mtimes[i]
+                remotefiletime = remote.mtimes[j]
+                if (remotefiletime-localfiletime) > 3 :
+                    diff.append((self.makeInfo(remote, j, remoteoffsets, remoteroot),"new in remote"))
+                if (localfiletime-remotefiletime) > 3:
+                    diff.append((self.makeInfo(local, i, localoffsets, localroot),"new in local"))
+        j = matched.find(0)
+        while j >= 0:
+            diff.append((self.makeInfo(remote, j, remoteoffsets, remoteroot),"only in remote"))
+            j = matched.find(0, j + 1)
+        msg = "Find " + str(len(diff)) + " difference items."
+        print(msg)
+        self.logger.info(msg)
+        return diff
+    
+
+    def makeSignature(self, filepath):
+        """Return the block signature of a local file for delta transfer.
+
+        The block size grows with square root of file size like rsync does,
+        every full block is signed by its adler32 and a blake2b hash.
+        """
+
+        size = os.path.getsize(filepath)
+        blocksize = max(2048, min(131072, math.isqrt(size) // 8 * 8))
+        signature = [self.SIG_HEAD.pack(blocksize)]
+        with open(filepath, "rb") as fp:
+            while True:
+                with self.diskslots:
+                    block = fp.read(blocksize)
+                if len(block) < blocksize:
+                    break
+                strong = hashlib.blake2b(block, digest_size=16).digest()
+                signature.append(self.SIG_ITEM.pack(zlib.adler32(block), strong))
+        return b"".join(signature)
+
+
+    def sendDelta(self, con, fp, signature):
+        """Send delta of an opened file against the signature of remote copy.
+
+        The window is rolled byte by byte to find moved blocks, so blocks
+        shifted by data inserted or deleted anywhere are found again. Each
+        step updates the adler32 of the window in O(1), the blake2b hash is
+        taken only when the adler32 is one of a block.
+        Return (bytes on wire, bytes matched).
+        """
+
+        blocksize = self.SIG_HEAD.unpack_from(signature)[0]
+        blocks = {}
+        items = self.SIG_ITEM.iter_unpack(memoryview(signature)[self.SIG_HEAD.size:])
+        for index, (weak, strong) in enumerate(items):
+            blocks.setdefault(weak, {}).setdefault(strong, index)
+
+        wire = 0
+        matched = 0
+        copyfirst = 0
+        copycount = 0
+
+        def flush(literal=b""):
+            nonlocal wire, copycount
+            if copycount:
+                op = b"C" + self.DELTA_COPY.pack(copyfirst, copycount)
+                self.sendMsg(con, self.MSG_DELTA, op)
+                wire = wire + self.FRAME_HEAD.size + len(op)
+                copycount = 0
+            if literal:
+                self.sendMsg(con, self.MSG_DELTA, b"L" + literal)
+                wire = wire + self.FRAME_HEAD.size + 1 + len(literal)
+
+        data = bytearray()
+        pos = 0     # start of the window in data
+        lit = 0     # start of literal data not sent
+        weak = None
+        eof = False
+        while True:
+            if len(data) - pos <= blocksize and not eof:
+                del data[:lit]  # drop data already sent
+                pos = pos - lit
+                lit = 0
+                chunk = fp.read(self.chunksize)
+                eof = not chunk
+                data += chunk
+                continue
+            if len(data) - pos < blocksize:
+                break
+            if weak is None:
+                weak = zlib.adler32(data[pos:pos + blocksize])
+            index = None
+            if weak in blocks:
+                strong = hashlib.blake2b(data[pos:pos + blocksize], digest_size=16).digest()
+                index = blocks[weak].get(strong)
+            if index is not None:
+                if pos > lit:
+                    flush(bytes(data[lit:pos]))
+                if not (copycount and copyfirst + copycount == index):
+                    flush()
+                    copyfirst = index
+                copycount = copycount + 1
+                matched = matched + blocksize
+                pos = pos + blocksize
+                lit = pos
+                weak = None
+                continue
+            end = len(data) - blocksize     # start of the last window in data
+            if pos >= end:  # no more data to roll in
+                pos = pos + 1
+                weak = None
+                continue
+            # roll the adler32 of window by one byte till it is one of a block
+            a = weak & 0xffff
+            b = weak >> 16
+            while pos < end:
+                out = data[pos]
+                a = (a - out + data[pos + blocksize]) % 65521
+                b = (b - blocksize * out + a - 1) % 65521
+                pos = pos + 1
+                if ((b << 16) | a) in blocks:
+                    break
+            weak = (b << 16) | a
+            if pos - lit >= self.chunksize:
+                flush(bytes(data[lit:pos]))
+                lit = pos
+        flush(bytes(data[lit:]))
+        self.sendMsg(con, self.MSG_CMD, self.CM_SEND_OVER)
+        wire = wire + self.FRAME_HEAD.size + len(self.CM_SEND_OVER)
+        return wire, matched
+
+
+    def recvDelta(self, con, basis, fp, blocksize, type, length):
+        """Rebuild a file from the basis copy and the delta frames of remote.
+
+        type and length are the head of the first frame, which is read.
+        Return (bytes on wire, size of file).
+        """
+
+        view = memoryview(self.getBuffer())
+        wire = 0
+        size = 0
+        with open(basis, "rb") as old:
+            while type == self.MSG_DELTA:
+                payload = self.recvExact(con, length)
+                wire = wire + self.FRAME_HEAD.size + length
+                if payload[:1] == b"L":
+                    with self.diskslots:
+                        fp.write(memoryview(payload)[1:])
+                    size = size + length - 1
+                else:
+                    first, count = self.DELTA_COPY.unpack_from(payload, 1)
+                    old.seek(first * blocksize)
+                    left = count * blocksize
+                    while left > 0:
+                        with self.diskslots:
+                            n = old.readinto(view[:min(left, len(view))])
+                            fp.write(view[:n])
+                        if n == 0:
+                            break
+                        left = left - n
+                        size = size + n
+                type, length = self.recvHead(con)
+            self.recvExact(con, length)    # end of delta
+        return wire + self.FRAME_HEAD.size + length, size
+
+
+    def sendBundle(self, con, paths, names=None):
+        """Send small files as one MSG_BUNDLE frame, return count of files sent.
+
+        names are the names of the files in the manifest, default is paths.
+        A file which is gone is left out of the bundle. The size in the
+        manifest is taken when the bundle starts, a file changed later is
+        cut or padded to it, and will be synced again next time. If remote
+        agreed a codec, the bundle is sent as one MSG_ZBUNDLE frame when
+        compression makes it smaller.
+        """
+
+        if names is None:
+            names = paths
+        items = []
+        for path, name in zip(paths, names):
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            items.append((path, name.encode(), st.st_size, st.st_mtime_ns))
+        manifest = [self.BUNDLE_HEAD.pack(len(items))]
+        for path, name, size, mtime in items:
+            manifest.append(self.BUNDLE_ITEM.pack(len(name), size, mtime) + name)
+        manifest = b"".join(manifest)
+        length = len(manifest) + sum(item[2] for item in items)
+        codec = self.codecs.get(con)
+        if codec:
+            wire = self.sendZBundle(con, items, manifest, length, codec)
+        else:
+            con.sendall(self.FRAME_HEAD.pack(self.MSG_BUNDLE, length) + manifest)
+            data = bytearray()
+            for content in self.readBundle(items):
+                data += content
+                if len(data) >= self.chunksize:
+                    con.sendall(data)
+                    data.clear()
+            con.sendall(data)
+            wire = length
+        msg = "Send bundle of " + str(len(items)) + " files, " + str(wire) + " bytes on wire."
+        self.logger.info(msg)
+        return len(items)
+
+
+    def readBundle(self, items):
+        """Yield the content of bundle items, each cut or padded to its size."""
+
+        for path, name, size, mtime in items:
+            try:
+                with self.diskslots, open(path, "rb") as fp:
+                    content = fp.read(size)
+            except OSError:
+                content = b""
+            yield content
+            if len(content) < size:
+                yield bytes(size - len(content))
+
+
+    def sendZBundle(self, con, items, manifest, length, codec):
+        """Send bundle items compressed by codec, or raw if that doesn't help.
+
+        Return bytes of payload on wire.
+        """
+
+        data = manifest + b"".join(self.readBundle(items))
+        if self.isCompressible("", data[len(manifest):len(manifest) + 65536]):
+            payload = self.compress(codec, data)
+            if len(payload) < length:
+                self.sendMsg(con, self.MSG_ZBUNDLE, payload)
+                return len(payload)
+        self.sendMsg(con, self.MSG_BUNDLE, data)
+        return length
+
+
+    def saveBundle(self, con, length, fromroot="", toroot="", type=MSG_BUNDLE):
+        """Receive the bundle frame of given length and save the files in it.
+
+        type is MSG_BUNDLE, or MSG_ZBUNDLE which is decompressed in memory.
+        Names of the files are mapped from fromroot to toroot. The parent
+        directories of all files are made at once before any file is written.
+        Files are written to partial files, then committed at once by
+        commitFiles, so the bundle costs one group of fsyncs. Return count
+        of files saved.
+        """
+
+        wire = length
+        if type == self.MSG_ZBUNDLE:
+            data = self.decompress(self.recvExact(con, length))
+            source = io.BytesIO(data)
+            length = len(data)
+        else:
+            source = con.makefile("rb", buffering=0)
+
+        def read(size):
+            data = bytearray(size)
+            view = memoryview(data)
+            filled = 0
+            while filled < size:
+                n = source.readinto(view[filled:])
+                if not n:
+                    raise ConnectionError("Connect closed by remote.")
+                filled = filled + n
+            return bytes(data)
+
+        count = self.BUNDLE_HEAD.unpack(read(self.BUNDLE_HEAD.size))[0]
+        left = length - self.BUNDLE_HEAD.size
+        items = []
+        for i in range(count):
+            namelen, size, mtime = self.BUNDLE_ITEM.unpack(read(self.BUNDLE_ITEM.size))
+            name = read(namelen).decode()
+            items.append((self.mapPath(name, fromroot, toroot), size, mtime))
+            left = left - self.BUNDLE_ITEM.size - namelen
+        for dir in sorted(set(os.path.dirname(item[0]) for item in items)):
+            os.makedirs(dir, exist_ok=True)
+
+        view = memoryview(self.getBuffer())
+        have = 0    # bytes received in buffer
+        pos = 0     # bytes of buffer written out
+        files = []  # (partial, filename, mtime) written
+        try:
+            for filename, size, mtime in items:
+                with self.getPathLock(filename):
+                    if os.path.exists(filename):
+                        self.saveVersion(filename)
+                    files.append((filename + self.PARTIAL, filename, mtime))
+                    with open(filename + self.PARTIAL, "wb") as fp:
+                        while size > 0:
+                            if pos == have:
+                                have = min(left, len(view))
+                                filled = 0
+                                while filled < have:
+                                    n = source.readinto(view[filled:have])
+                                    if not n:
+                                        raise ConnectionError("Connect closed by remote.")
+                                    filled = filled + n
+                                left = left - have
+                                pos = 0
+                            n = min(size, have - pos)
+                            with self.diskslots:
+                                fp.write(view[pos:pos + n])
+                            pos = pos + n
+                            size = size - n
+        except BaseException:
+            for partial, filename, mtime in files:
+                with contextlib.suppress(OSError):
+                    os.remove(partial)
+            raise
+        finally:
+            source.close()
+        self.commitFiles(files)
+        msg = "End receive and save bundle of " + str(count) + " files, " + str(wire) + " bytes on wire"
+        self.logger.info(msg)
+        return count
+
+
+    def sendFile(self,con,filepath,signature=b"",offer=None):
+        """Send file to remote. If not success, return -1.
+
+        If signature of remote copy is given, only the delta is sent. If
+        offer of a checkpoint is given, the content is resumed from it.
+        """
+
+        status = 0
+        if os.path.exists(filepath):
+            msg = "Find the" + filepath +"and sending file to remote."
+            self.logger.info(msg)
+            with open(filepath,'rb') as fp:
+                size = os.fstat(fp.fileno()).st_size
+                if signature:
+                    wire, matched = self.sendDelta(con, fp, signature)
+                elif offer is not None:
+                    wire = self.sendFrom(con, fp, size, filepath, offer)
+                else:
+                    wire = self.sendContent(con, fp, size, filepath)
+            msg = "End send file:" + filepath + ",total size is " + str(size) + ", " + str(wire) + " bytes on wire"
+        else:
+            msg = "Can't find the" + filepath +",please check file name is correct."
+            self.sendMsg(con, self.MSG_ERR, msg.encode())
+            status = -1
+        print(msg)
+        self.logger.info(msg)
+        return status
+
+
+    def saveFile(self, con, filename, blocksize=0, mtime=None):
+        """Receive the file content sent by remote and save it to filename.
+
+        The content is one MSG_DATA frame, MSG_ZDATA frames, or MSG_DELTA
+        frames against the local copy whose signature used blocksize. It
+        is written to a partial file first, which is committed to filename
+        by commitFiles only when all is received. If the content is led by a MSG_FROM
+        frame, the partial file keeps a checkpoint to resume from, and is
+        verified against the hash of whole file before the rename. If
+        mtime is given, the saved file gets it, so both copies look same
+        to the directory digests. Return size of the saved file, or -1 if
+        remote can't send it.
+        """
+
+        type, length = self.recvHead(con)
+        if type == self.MSG_ERR:
+            msg = "Get remote file failed:" + self.recvExact(con, length).decode()
+            print(msg)
+            self.logger.error(msg)
+            return -1
+
+        partial = filename + self.PARTIAL
+        start = 0
+        digest = None
+        if type == self.MSG_FROM:
+            start, digest = self.RESUME.unpack(self.recvExact(con, length))
+            type, length = self.recvHead(con)
+        offset, h = self.resumes.pop(filename, (0, None))
+        if start and (start != offset or h is None):
+            raise ConnectionError("Remote resumes from " + str(start) + " which is not offered.")
+        if not start:
+            h = hashlib.blake2b(digest_size=16)
+
+        with open(partial, "r+b" if start else "wb") as file:
+            if start:
+                file.truncate(start)
+                file.seek(start)
+                msg = "Resume receiving file:" + filename + " from " + str(start)
+                print(msg)
+                self.logger.info(msg)
+            if digest is not None:
+                file = PartialFile(file, h, filename + self.CHECKPOINT, digest, self.checkpoint)
+            try:
+                if type == self.MSG_DATA:
+                    size = self.recvStream(con, file, length)
+                    wire = self.FRAME_HEAD.size + length
+                elif type == self.MSG_ZDATA:
+                    wire, size = self.recvCompressed(con, file, type, length)
+                else:   # delta frames, or end of an empty delta
+                    wire, size = self.recvDelta(con, filename, file, blocksize, type, length)
+            except BaseException:
+                if digest is None:  # nothing to resume from
+                    file.close()
+                    os.remove(partial)
+                else:   # all written so far is good to resume from
+                    with contextlib.suppress(OSError):
+                        file.save()
+                raise
+        if digest is not None:
+            with contextlib.suppress(FileNotFoundError):   # none if smaller than checkpoint
+                os.remove(filename + self.CHECKPOINT)
+            if h.digest() != digest:
+                os.remove(partial)
+                msg = "Receive file:" + filename + " failed, content does not match the hash of remote."
+                print(msg)
+                self.logger.error(msg)
+                return -1
+            size = start + size
+
+        if os.path.exists(filename):    #if have same file,keep a version of it.
+            msg = "Local computer has same name file, keep a version of the file:" + filename
+            self.logger.info(msg)
+            self.saveVersion(filename)
+        self.commitFiles([(partial, filename, None if mtime is None else mtime * 1000000000)], lock=False)
+        msg = "End receive and save file:" + filename + ",total size is " + str(size) + ", " + str(wire) + " bytes on wire"
+        self.logger.info(msg)
+        return size
+
+
+    def commitFiles(self, files, lock=True):
+        """Move received partial files into place, files are (partial, filename, mtime_ns).
+
+        If fsync of [transfer] is on, the content of all files is flushed to
+        disk before any rename, and the renames are flushed after, each by
+        one group of syncPaths. So after a crash or power loss a file is the
+        old one or the whole new one, never a torn one. mtime is given to
+        the file if not None. lock takes the path lock of each file, off if
+        the caller holds it.
+        """
+
+        if self.fsync:
+            self.syncPaths([partial for partial, filename, mtime in files])
+        dirs = set()
+        for partial, filename, mtime in files:
+            with self.getPathLock(filename) if lock else contextlib.nullcontext():
+                try:
+                    if mtime is not None:
+                        os.utime(partial, ns=(mtime, mtime))
+                    os.replace(partial, filename)
+                except FileNotFoundError:
+                    continue    # committed by another writer of same path
+                if self.written is not None:    # its change event is not pushed back
+                    self.written[filename] = os.stat(filename).st_mtime_ns
+            dirs.add(os.path.dirname(filename))
+        if self.fsync and os.name != "nt":  # directories can't be opened on windows
+            self.syncPaths(sorted(dirs))
+
+
+    def syncPaths(self, paths):
+        """Flush files or directories of paths to disk.
+
+        Each is flushed by fsync. With [transfer] syncfs, more than one is
+        flushed by one syncfs for each file system where the system has it,
+        which also flushes what other programs wrote there.
+        """
+
+        if self.syncfs is None and sys.platform.startswith("linux"):
+            libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+            self.syncfs = getattr(libc, "syncfs", False)
+        synced = set()  # devices flushed by syncfs
+        for path in paths:
+            try:
+                fd = os.open(path, os.O_RDONLY)
+            except OSError:
+                continue    # gone meanwhile
+            try:
+                if len(paths) > 1 and self.syncfs:
+                    dev = os.fstat(fd).st_dev
+                    if dev in synced:
+                        continue
+                    if self.syncfs(fd) == 0:
+                        synced.add(dev)
+                        continue
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+
+    def sendFrom(self, con, fp, size, filepath, offer):
+        """Send an opened file resumed from the checkpoint offered by remote.
+
+        The offset is taken if remote's partial file is of the same content,
+        then a MSG_FROM frame leads the content from it. Return bytes on wire.
+        """
+
+        offset, wanted = self.RESUME.unpack(offer)
+        digest = self.getHash(filepath)
+        start = offset if wanted == digest and offset <= size else 0
+        self.sendMsg(con, self.MSG_FROM, self.RESUME.pack(start, digest))
+        fp.seek(start)
+        return self.FRAME_HEAD.size + self.RESUME.size + self.sendContent(con, fp, size - start, filepath)
+
+
+    def getCheckpoint(self, filename):
+        """Return the offer of the checkpoint of filename, packed in RESUME.
+
+        The partial file is read up to the checkpoint to check it, and the
+        hash of it is kept for saveFile. No checkpoint offers offset 0.
+        """
+
+        offset = 0
+        digest = bytes(16)
+        try:
+            with open(filename + self.CHECKPOINT, encoding="utf-8") as f:
+                offset, prefix, digest = f.read().split(",")
+            offset = int(offset)
+            digest = bytes.fromhex(digest)
+            h = hashlib.blake2b(digest_size=16)
+            view = memoryview(bytearray(self.chunksize))
+            with open(filename + self.PARTIAL, "rb") as fp:
+                left = offset
+                while left > 0:
+                    n = fp.readinto(view[:min(left, len(view))])
+                    if n == 0:
+                        break
+                    h.update(view[:n])
+                    left = left - n
+            if left > 0 or h.hexdigest() != prefix:
+                offset = 0
+            else:
+                self.resumes[filename] = (offset, h)
+        except (OSError, ValueError):
+            offset = 0
+        if offset == 0:
+            self.resumes.pop(filename, None)
+        return self.RESUME.pack(offset, digest)
+
+
+    def recvFile(self, con, filepath, delta=False):
+        """Receive a file and save it to specific directory.
+
+        If delta is True, send signature of the local copy to remote first,
+        or the checkpoint of a large file if there is no local copy.
+        """
+
+        filename, type, size, mtime = filepath.rsplit(",", 3)
+        msg = "Receiving file which name is " + filename
+        self.logger.info(msg)
+
+        blocksize = 0
+        if delta and not os.path.isfile(filename) and int(size) >= self.resumemin:
+            self.sendMsg(con, self.MSG_FROM, self.getCheckpoint(filename))
+        elif delta:
+            signature = b""
+            if os.path.isfile(filename):
+                signature = self.makeSignature(filename)
+                blocksize = self.SIG_HEAD.unpack_from(signature)[0]
+            self.sendMsg(con, self.MSG_SIG, signature)
+        return self.saveFile(con, filename, blocksize, int(mtime))
+
+
+    def recvDir(self,dir):
+        """Receive remote directory and create on local computer."""
+
+        if os.path.exists(dir):
+            msg = "The local computer has same directory:" + dir
+            self.logger.info(msg)
+            return -1
+        else:
+            os.mkdir(dir)
+            msg = "Make the new directory " + dir
+            self.logger.info(msg)
+            return 0
+
+
+    def getRemoteFile(self,con, path):
+        """Get the remote directory or file and save to local."""
+
+        remotefile, type, size, mtime = path.rsplit(",", 3)
+        filepath = self.mapPath(remotefile, self.remotepath, self.localpath)
+        msg = "Getting remote file:" + remotefile
+        self.logger.info(msg)
+        if type == "d": # directory
+            if os.path.exists(filepath):
+                msg = "Local computer has same directory:" + filepath
+            else:
+                msg = "Create new directory:" + filepath
+                os.mkdir(filepath)  
+            self.logger.info(msg)
+        else:   # file
+            if os.path.isfile(filepath) and os.path.getsize(filepath) >= self.deltamin:
+                signature = self.makeSignature(filepath)
+                self.sendMsg(con, self.MSG_CMD, self.CM_FETCH_DELTA)
+                self.sendMsg(con, self.MSG_DATA, remotefile.encode())  # send file name
+                self.sendMsg(con, self.MSG_SIG, signature)
+                blocksize = self.SIG_HEAD.unpack_from(signature)[0]
+            elif int(size) >= self.resumemin:
+                self.sendMsg(con, self.MSG_CMD, self.CM_FETCH_RESUME)
+                self.sendMsg(con, self.MSG_DATA, remotefile.encode())  # send file name
+                self.sendMsg(con, self.MSG_FROM, self.getCheckpoint(filepath))
+                blocksize = 0
+            else:
+                self.sendMsg(con, self.MSG_CMD, self.CM_FETCH_FILE)
+                self.sendMsg(con, self.MSG_DATA, remotefile.encode())  # send file name
+                blocksize = 0
+            if self.saveFile(con, filepath, blocksize, int(mtime)) < 0:
+                return -1
+        return 0
+    
+    def getVersions(self):
+        """Open the database of version store, return the connect.
+
+        A version is a list of chunk hashes, a chunk is stored once in a
+        file named by its hash however many versions have it.
+        """
+
+        if self.versions is None:
+            os.makedirs(os.path.join(self.versiondir, "chunks"), exist_ok=True)
+            db = sqlite3.connect(os.path.join(self.versiondir, "versions.db"), timeout=60,
+                                 check_same_thread=False)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("CREATE TABLE IF NOT EXISTS version (id INTEGER PRIMARY KEY, path TEXT, "
+                       "time REAL, size INTEGER, mtime_ns INTEGER, chunks BLOB)")
+            db.execute("CREATE INDEX IF NOT EXISTS version_path ON version (path, time)")
+            db.execute("CREATE TABLE IF NOT EXISTS chunk (hash BLOB PRIMARY KEY, refs INTEGER)")
+            db.execute("CREATE INDEX IF NOT EXISTS chunk_refs ON chunk (refs)")
+            db.commit()
+            self.versions = db
+        return self.versions
+
+
+    def getChunkFile(self, digest):
+        """Return path of the file of a stored chunk."""
+
+        name = digest.hex()
+        return os.path.join(self.versiondir, "chunks", name[:2], name[2:])
+
+
+    def saveVersion(self, path):
+        """Keep the content of a local file in version store, return id of the version.
+
+        The file is cut into chunks of versionchunk bytes, only the chunks
+        not stored yet are written. Older versions of the file beyond
+        retention are dropped.
+        """
+
+        st = os.stat(path)
+        hashes = []
+        new = {}    # hash -> chunk not stored yet
+        db = self.getVersions()
+        with self.versionlock:
+            self.saving = self.saving + 1
+        try:
+            with open(path, "rb") as fp:
+                while True:
+                    with self.diskslots:
+                        chunk = fp.read(self.versionchunk)
+                    if not chunk:
+                        break
+                    digest = hashlib.blake2b(chunk, digest_size=16).digest()
+                    hashes.append(digest)
+                    if digest in new:
+                        continue
+                    chunkfile = self.getChunkFile(digest)
+                    if not os.path.exists(chunkfile):
+                        os.makedirs(os.path.dirname(chunkfile), exist_ok=True)
+                        tmpfile = chunkfile + "." + str(threading.get_ident()) + ".tmp"
+                        with self.diskslots, open(tmpfile, "wb") as f:
+                            f.write(chunk)
+                        os.replace(tmpfile, chunkfile)
+                        new[digest] = True
+            with self.versionlock:
+                db.executemany("INSERT OR IGNORE INTO chunk VALUES (?,0)", [(digest,) for digest in hashes])
+                db.executemany("UPDATE chunk SET refs=refs+1 WHERE hash=?", [(digest,) for digest in hashes])
+                id = db.execute("INSERT INTO version (path,time,size,mtime_ns,chunks) VALUES (?,?,?,?,?)",
+                                (path, time.time(), st.st_size, st.st_mtime_ns, b"".join(hashes))).lastrowid
+                db.commit()
+        finally:
+            with self.versionlock:
+                self.saving = self.saving - 1
+        msg = ("File: " + path + " is kept as version " + str(id) + ", " + str(len(new)) + " of "
+               + str(len(hashes)) + " chunks are new.")
+        self.logger.info(msg)
+        self.collectVersions(path)
+        return id
+
+
+    def listVersions(self, path):
+        """Return (id, time, size, mtime_ns) of the kept versions of path, newest first."""
+
+        db = self.getVersions()
+        with self.versionlock:
+            return db.execute("SELECT id,time,size,mtime_ns FROM version WHERE path=? ORDER BY time DESC",
+                              (path,)).fetchall()
+
+
+    def restoreVersion(self, path, id=None, dest=None):
+        """Write a kept version of path to dest, default is path itself.
+
+        id is the version to restore, default is the newest. The current
+        file at dest is kept as a version first. Return size restored, or
+        -1 if there is no such version.
+        """
+
+        db = self.getVersions()
+        with self.versionlock:
+            if id is None:
+                row = db.execute("SELECT size,mtime_ns,chunks FROM version WHERE path=? "
+                                 "ORDER BY time DESC LIMIT 1", (path,)).fetchone()
+            else:
+                row = db.execute("SELECT size,mtime_ns,chunks FROM version WHERE path=? AND id=?",
+                                 (path, id)).fetchone()
+        if row is None:
+            msg = "No version of " + path + " to restore."
+            print(msg)
+            self.logger.error(msg)
+            return -1
+        size, mtime, chunks = row
+        if dest is None:
+            dest = path
+        partial = dest + self.PARTIAL
+        with open(partial, "wb") as fp:
+            for i in range(0, len(chunks), 16):
+                with open(self.getChunkFile(chunks[i:i + 16]), "rb") as f:
+                    fp.write(f.read())
+        if os.path.exists(dest):
+            self.saveVersion(dest)
+        os.replace(partial, dest)
+        os.utime(dest, ns=(mtime, mtime))
+        msg = "Restore version of " + path + " to " + dest
+        print(msg)
+        self.logger.info(msg)
+        return size
+
+
+    def collectVersions(self, path=None):
+        """Drop versions beyond retention and the chunks no version has.
+
+        A version is dropped if keepversions newer ones of the same file are
+        kept, or it is older than keepdays. If path is given, only versions
+        of it are looked at and the chunks are left for the collect at the
+        end of the cycle. Return count of versions dropped.
+        """
+
+        db = self.getVersions()
+        dropped = []
+        sweep = path is None
+        with self.versionlock:
+            if path is None:
+                paths = [row[0] for row in db.execute("SELECT DISTINCT path FROM version")]
+            else:
+                paths = [path]
+            old = time.time() - self.keepdays * 86400
+            for path in paths:
+                rows = db.execute("SELECT id,time,chunks FROM version WHERE path=? ORDER BY time DESC",
+                                  (path,)).fetchall()
+                for n, (id, t, chunks) in enumerate(rows):
+                    if (self.keepversions and n >= self.keepversions) or (self.keepdays and t < old):
+                        dropped.append((id, chunks))
+            for id, chunks in dropped:
+                db.execute("DELETE FROM version WHERE id=?", (id,))
+                db.executemany("UPDATE chunk SET refs=refs-1 WHERE hash=?",
+                               [(chunks[i:i + 16],) for i in range(0, len(chunks), 16)])
+            garbage = []
+            if sweep and not self.saving:     # a version being saved may use a chunk of no refs
+                garbage = [row[0] for row in db.execute("SELECT hash FROM chunk WHERE refs<=0")]
+                db.executemany("DELETE FROM chunk WHERE hash=?", [(digest,) for digest in garbage])
+                for digest in garbage:
+                    with contextlib.suppress(OSError):
+                        os.remove(self.getChunkFile(digest))
+            db.commit()
+        if dropped:
+            msg = "Drop " + str(len(dropped)) + " versions and " + str(len(garbage)) + " chunks."
+            if sweep:
+                print(msg)
+            self.logger.info(msg)
+        return len(dropped)
+
+
+    def updateRemote(self,con, path):
+        """Push local directory or file to remote."""
+        pathlist = path.rsplit(",", 3)
+        remotefile = self.mapPath(pathlist[0], self.localpath, self.remotepath)
+        path = ",".join([remotefile] + pathlist[1:])  # remote saves it as it is
+        if pathlist[1] == "d":
+            self.sendMsg(con, self.MSG_CMD, self.CM_PUSH_DIR)
+            self.sendMsg(con, self.MSG_DATA, remotefile.encode())
+            msg = "Send local directory to remote:"+ pathlist[0]    
+
+        if pathlist[1] == "f":
+            with open(pathlist[0],"rb") as fp:
+                size = os.fstat(fp.fileno()).st_size
+                offer = None
+                if size >= self.deltamin:   # remote answers signature of its copy, or checkpoint
+                    self.sendMsg(con, self.MSG_CMD, self.CM_PUSH_DELTA)
+                    self.sendMsg(con, self.MSG_DATA, path.encode())
+                    type, signature = self.recvMsg(con)
+                    if type == self.MSG_FROM:
+                        signature, offer = b"", signature
+                else:
+                    self.sendMsg(con, self.MSG_CMD, self.CM_PUSH_FILE)
+                    self.sendMsg(con, self.MSG_DATA, path.encode())
+                    signature = b""
+                if signature:
+                    wire, matched = self.sendDelta(con, fp, signature)
+                elif offer is not None:
+                    wire = self.sendFrom(con, fp, size, pathlist[0], offer)
+                else:
+                    wire = self.sendContent(con, fp, size, pathlist[0])
+            msg = "Send local file to remote:"+ pathlist[0] + ", " + str(wire) + " bytes on wire for " + str(size)
+        self.logger.info(msg)
+        return 0
+    
+    def sendFolder(self,con,folder,synctime=0):
+        """Send details of directory to remote, folder is a list or generator of path info.
+
+        Path info are packed into MSG_LIST frames of about LIST_BATCH bytes,
+        so a large listing goes at line rate in few send calls.
+        """
+
+        codec = self.codecs.get(con)
+        batch = []
+        batchsize = 0
+        count = 0
+        for rec in folder:
+            count = count + 1
+            batch.append(rec)
+            batchsize = batchsize + len(rec) + 1
+            if batchsize >= self.LIST_BATCH:
+                self.sendList(con, batch, codec)
+                batch = []
+                batchsize = 0
+        if batch:
+            self.sendList(con, batch, codec)
+        self.sendMsg(con, self.MSG_CMD, self.CM_SEND_OVER)
+
+        msg = "Send " + str(count) + "to remote."
+        self.logger.info(msg)
+
+
+    def sendListing(self, con, listing):
+        """Send a Listing to remote in MSG_ITEMS frames, or MSG_ZITEMS by codec."""
+
+        codec = self.codecs.get(con)
+        for data in listing.frames(self.ITEMS_BATCH):
+            if codec:
+                self.sendMsg(con, self.MSG_ZITEMS, self.compress(codec, data))
+            else:
+                self.sendMsg(con, self.MSG_ITEMS, data)
+        self.sendMsg(con, self.MSG_CMD, self.CM_SEND_OVER)
+
+        msg = "Send " + str(len(listing)) + " entries to remote."
+        print(msg)
+        self.logger.info(msg)
+
+
+    def sendList(self, con, batch, codec=None):
+        """Send a batch of path info in one MSG_LIST frame, or MSG_ZLIST by codec."""
+
+        data = "\0".join(batch).encode()
+        if codec:
+            self.sendMsg(con, self.MSG_ZLIST, self.compress(codec, data))
+        else:
+            self.sendMsg(con, self.MSG_LIST, data)
+
+
+    def syncFolder(self, con):
+        """Sync local directory with remote directory once on an open connect.
+
+        Return count of difference items, or -1 if now is not the sync time.
+        """
+
+        now = int(time.time())
+        if self.synctime == "" : 
+            lastsync = 0
+            msg = "First time sync, start full sync."
+        else:
+            msg = "The last sync time is:" + self.synctime
+            lastsync = time.strptime(self.synctime,"%Y-%m-%d %H:%M:%S")
+            lastsync = int(time.mktime(lastsync))
+        print(msg)
+        self.logger.info(msg)
+        if now <= lastsync:
+            msg ="Now is not the scheduled sync time:" + self.synctime + "end sync."
+            print(msg)
+            self.logger.info(msg)
+            return -1
+
+        self.beginCycle()
+        self.metabytes = 0
+        with self.metrics.phase("scan"):
+            if lastsync == 0:   # full sync walks only the subtrees differ
+                localfolder, remotefolder = self.getTreeFolders(con)
+            else:
+                localfolder = self.getFolder(self.localpath,lastsync)               
+                remotefolder = self.getRemoteFolder(con,self.remotepath,lastsync)
+        msg = "Get the local and remote directory info, " + str(self.metabytes) + " bytes from remote."
+        print(msg)
+        self.logger.info(msg)
+        self.metrics.add("metadata_bytes", self.metabytes)
+
+        #compare difference        
+        with self.metrics.phase("diff"):
+            diff = self.getDiff(localfolder,remotefolder)
+
+        failed = False
+        if diff:
+            with self.metrics.phase("transfer"):
+                failed = self.transferDiff(con, diff) < 0
+            msg = "End deal diff directory|file."
+        else:
+            msg = "No difference found after last sync, end sync."
+        print(msg)
+        self.logger.info(msg)
+        if failed:  # the files lost are listed again by next sync from the last sync time
+            msg = "Keep the last sync time, the files not transferred are synced next time."
+            print(msg)
+            self.logger.error(msg)
+        else:
+            self.synctime = time.strftime("%Y-%m-%d %H:%M:%S",time.localtime())
+            self.setconfig("time","synctime",self.synctime)
+        self.collectVersions()
+        self.reportCompress()
+        self.endCycle(len(diff))
+        return len(diff)
+
+
+    def beginCycle(self):
+        """Reset the metrics of a sync cycle, start the profilers set in config.ini."""
+
+        self.metrics.begin()
+        if self.profilefile:
+            self.profiler = cProfile.Profile()  # profiles this thread only, not the workers
+            self.profiler.enable()
+        if self.tracetop and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        if self.tracetop:
+            tracemalloc.reset_peak()
+
+
+    def endCycle(self, items):
+        """Stop the profilers, save and log the JSON summary of the cycle, return it."""
+
+        if self.profiler is not None:
+            self.profiler.disable()
+            self.profiler.dump_stats(self.profilefile)
+            self.profiler = None
+        summary = self.metrics.end()
+        summary["items"] = items
+        if self.tracetop:
+            snapshot = tracemalloc.take_snapshot()
+            summary["memory"] = {"peak": tracemalloc.get_traced_memory()[1],
+                                 "top": [str(stat) for stat in snapshot.statistics("lineno")[:self.tracetop]]}
+        text = json.dumps(summary)
+        if self.summaryfile:
+            with open(self.summaryfile + ".tmp", "w", encoding="utf-8") as f:
+                f.write(text)
+            os.replace(self.summaryfile + ".tmp", self.summaryfile)
+        msg = ("Sync cycle in %.3fs, scan %.3fs, diff %.3fs, transfer %.3fs, %.1f files/s, %.1f MB/s"
+               % (summary["seconds"], summary["phases"].get("scan", 0), summary["phases"].get("diff", 0),
+                  summary["phases"].get("transfer", 0), summary["files_per_second"], summary["mb_per_second"]))
+        print(msg)
+        self.logger.info(msg)
+        self.logger.info("Metrics " + text)
+        return summary
+
+
+    def startMetrics(self):
+        """Serve the metrics on 127.0.0.1:port of [metrics], return the server or None if off."""
+
+        if not self.metricsport:
+            return None
+        try:
+            server = http.server.ThreadingHTTPServer(("127.0.0.1", self.metricsport), MetricsHandler)
+        except OSError as e:
+            msg = "Can't serve metrics on port " + str(self.metricsport) + ":" + str(e)
+            print(msg)
+            self.logger.error(msg)
+            return None
+        server.daemon_threads = True
+        server.metrics = self.metrics
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        msg = "Serve metrics on http://127.0.0.1:" + str(self.metricsport) + "/metrics"
+        print(msg)
+        self.logger.info(msg)
+        return server
+
+
+    def transferDiff(self, con, diff):
+        """Deal the difference items, return count of files transferred, or -1 if some are lost.
+
+        Directories are made first, in order. Then the files are scheduled
+        by priority of getPriority, and largest first of same priority, over
+        up to workers connects. On each connect up to pipeline fetch
+        requests are in flight, and files smaller than batchsize go
+        batchcount or bundlesize bytes at a time in one bundle.
+        """
+
+        files = []  # (path info, kind, size)
+        for info, kind in diff:
+            path, type, size, mtime = info.rsplit(",", 3)
+            kind = "pull" if kind == "new in remote" or kind == "only in remote" else "push"
+            if type == "d":
+                if kind == "pull":
+                    self.getRemoteFile(con, info)   # only make the directory
+                else:
+                    self.updateRemote(con, info)
+            else:
+                files.append((info, kind, int(size)))
+        files = self.dedupFiles(con, files)
+
+        jobs = []   # (size, kind, path infos, priority)
+        batch = collections.defaultdict(list)   # (kind, priority) -> path infos
+        batchsize = collections.defaultdict(int)
+        for info, kind, size in files:
+            priority = self.getPriority(size, int(info.rsplit(",", 1)[1]))
+            if size < self.batchsize:
+                key = (kind, priority)
+                batch[key].append(info)
+                batchsize[key] = batchsize[key] + size
+                if len(batch[key]) >= self.batchcount or batchsize[key] >= self.bundlesize:
+                    jobs.append((batchsize[key], kind, batch.pop(key), priority))
+                    batchsize[key] = 0
+            else:
+                jobs.append((size, kind, [info], priority))
+        for (kind, priority), infos in batch.items():
+            if infos:
+                jobs.append((batchsize[(kind, priority)], kind, infos, priority))
+        jobs.sort(key=lambda job: (-job[3], job[0]))   # urgent and largest is popped first
+
+        cons = [con]
+        for i in range(min(self.workers, len(jobs)) - 1):
+            extra = self.connect()
+            if extra is None:
+                break
+            cons.append(extra)
+        progress = {"files": 0, "bytes": 0, "start": time.time(), "report": time.time(),
+                    "total": sum(len(job[2]) for job in jobs), "lock": threading.Condition(), "jobs": jobs,
+                    "busy": 0, "skipped": 0}
+        threads = [threading.Thread(target=self.runTransfer, args=(c, progress)) for c in cons[1:]]
+        for t in threads:
+            t.start()
+        self.runTransfer(con, progress)
+        self.local.urgent = False
+        for t in threads:
+            t.join()
+        for extra in cons[1:]:
+            try:
+                self.sendMsg(extra, self.MSG_CMD, self.CM_SYNC_OVER)
+                extra.settimeout(self.readtimeout)
+                extra.recv(1)   # remote closes it when all pushed on it is saved
+            except OSError:
+                pass
+            extra.close()
+        self.reportProgress(progress, 0, 0, True)
+        if progress["jobs"] or progress["skipped"]:    # connects failed, or local files did
+            msg = ("Transfer failed, " + str(sum(len(job[2]) for job in progress["jobs"]) + progress["skipped"])
+                   + " files are not transferred.")
+            print(msg)
+            self.logger.error(msg)
+            return -1
+        return progress["files"]
+
+
+    def dedupFiles(self, con, files):
+        """Copy the files whose content is on the receiving side already, return the rest.
+
+        files are (path info, kind, size). A pulled file is copied from a
+        local file of same content, a pushed file is copied by remote from
+        a remote file of same content, which remote finds in its index by
+        size. Only files of at least dedupmin bytes whose size matches are
+        hashed, hashes are cached in the manifest index on both sides.
+        """
+
+        pulls = {}  # size -> remote files to pull
+        pushes = {}     # size -> local files to push
+        for info, kind, size in files:
+            if size >= self.dedupmin:
+                (pulls if kind == "pull" else pushes).setdefault(size, []).append(info.rsplit(",", 3)[0])
+        db = self.getIndex()
+        lower, upper = self.getPrefix(self.localpath)
+        local = {}  # size -> local files of it
+        with self.indexlock:
+            for size in pulls:
+                rows = db.execute("SELECT path FROM entry WHERE size=? AND type='f' AND path>=? AND path<?",
+                                  (size, lower, upper)).fetchall()
+                if rows:
+                    local[size] = [row[0] for row in rows]
+        names = [name for size in local for name in pulls[size]]
+        if not names and not pushes:
+            return files
+
+        remotehash = {}     # remote file to pull -> content hash
+        if names:
+            self.sendMsg(con, self.MSG_CMD, self.CM_FETCH_HASH)
+            self.sendMsg(con, self.MSG_LIST, "\0".join(names).encode())
+            remotehash = dict(zip(names, self.recvList(con)))
+        remote = {}     # content hash -> remote file
+        for name, digest in remotehash.items():
+            if digest:
+                remote.setdefault(digest, name)
+        if pushes:
+            self.sendMsg(con, self.MSG_CMD, self.CM_FETCH_SIZE)
+            self.sendMsg(con, self.MSG_DATA, self.remotepath.encode())
+            self.sendMsg(con, self.MSG_LIST, "\0".join(str(size) for size in pushes).encode())
+            found = set()   # sizes of pushed files remote has files of
+            for item in self.recvList(con):
+                if item:
+                    digest, size, name = item.split(",", 2)
+                    remote.setdefault(digest, name)
+                    found.add(int(size))
+            for size in found:
+                local.setdefault(size, []).extend(pushes[size])
+        localhash = {}  # local file -> content hash
+        for paths in local.values():
+            for path in paths:
+                if path in localhash:
+                    continue
+                try:
+                    localhash[path] = self.getHash(path).hex()
+                except OSError:
+                    continue
+        content = {}    # content hash -> local file
+        for path, digest in localhash.items():
+            content.setdefault(digest, path)
+
+        left = []
+        copies = []     # (path info, kind, size) remote is asked to copy
+        count = 0
+        saved = 0
+        for info, kind, size in files:
+            path, type, filesize, mtime = info.rsplit(",", 3)
+            if kind == "pull" and remotehash.get(path) in content:
+                filepath = self.mapPath(path, self.remotepath, self.localpath)
+                if content[remotehash[path]] != filepath:
+                    try:
+                        with self.getPathLock(filepath):
+                            self.copyFile(content[remotehash[path]], filepath, int(mtime))
+                    except OSError as e:    # the local copy is gone, pull the file
+                        msg = "Copy file " + content[remotehash[path]] + " failed:" + str(e)
+                        self.logger.error(msg)
+                        left.append((info, kind, size))
+                        continue
+                    count = count + 1
+                    saved = saved + size
+                    continue
+            if kind == "push" and localhash.get(path) in remote:
+                remotefile = self.mapPath(path, self.localpath, self.remotepath)
+                if remote[localhash[path]] != remotefile:
+                    self.sendMsg(con, self.MSG_CMD, self.CM_COPY_FILE)
+                    data = remote[localhash[path]] + "\0" + ",".join([remotefile, type, filesize, mtime])
+                    self.sendMsg(con, self.MSG_DATA, data.encode())
+                    copies.append((info, kind, size))
+                    continue
+            left.append((info, kind, size))
+        for info, kind, size in copies:     # remote answers each copy in order
+            type, answer = self.recvMsg(con)
+            if type == self.MSG_ERR:    # push the file instead
+                self.logger.error(answer.decode())
+                left.append((info, kind, size))
+            else:
+                count = count + 1
+                saved = saved + size
+        msg = "Copy " + str(count) + " files of " + str(saved) + " bytes of same content instead of transfer."
+        print(msg)
+        self.logger.info(msg)
+        return left
+
+
+    def listSize(self, folder, sizes):
+        """Return "hash,size,path" of the files under folder in the index of the given sizes."""
+
+        db = self.getIndex()
+        lower, upper = self.getPrefix(folder)
+        with self.indexlock:
+            paths = [row for size in sizes if size >= self.dedupmin
+                     for row in db.execute("SELECT path,size FROM entry WHERE size=? AND type='f' AND path>=? AND path<?",
+                                           (size, lower, upper)).fetchall()]
+        items = []
+        for path, size in paths:
+            try:
+                items.append(self.getHash(path).hex() + "," + str(size) + "," + path)
+            except OSError:
+                continue    # gone since indexed
+        return items
+
+
+    def copyFile(self, src, dst, mtime):
+        """Copy a local file of the content wanted at dst, and give dst the mtime."""
+
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        if os.path.exists(dst):
+            self.saveVersion(dst)
+        shutil.copyfile(src, dst + self.PARTIAL)
+        self.commitFiles([(dst + self.PARTIAL, dst, mtime * 1000000000)], lock=False)
+        msg = "Copy file " + src + " to " + dst
+        self.logger.info(msg)
+
+
+    def runTransfer(self, con, progress):
+        """Take jobs of transferDiff one by one and deal them on one connect.
+
+        If the connect fails, the jobs taken and not done are given back,
+        for the other connects to take. A connect with nothing to do waits
+        while jobs are taken by others, as they may be given back. A job
+        failed by a local file, like one removed since the scan, is skipped.
+        The connect is dropped too if that leaves it in a frame from remote.
+        """
+
+        pending = collections.deque()
+        job = None  # job being dealt out of the pipeline
+
+        def receive():
+            item = pending[0]
+            try:
+                self.recvJob(con, *item, progress)
+            except OSError as e:
+                if e.filename is None:
+                    raise   # the connect failed
+                pending.popleft()
+                self.skipJob(progress, item[0], e)
+                raise ConnectionError("Left in a frame by " + str(e)) from e
+            self.doneJob(progress, pending.popleft()[0])
+
+        try:
+            while True:
+                while len(pending) < self.pipeline:
+                    with progress["lock"]:
+                        while not progress["jobs"] and progress["busy"] and not pending:
+                            progress["lock"].wait()
+                        job = progress["jobs"].pop() if progress["jobs"] else None
+                        if job is not None:
+                            progress["busy"] = progress["busy"] + 1
+                    if job is None:
+                        break
+                    size, kind, infos, priority = job
+                    filepath = self.mapPath(infos[0].rsplit(",", 3)[0], self.remotepath, self.localpath)
+                    if kind == "push" or (os.path.isfile(filepath) and os.path.getsize(filepath) >= self.deltamin):
+                        # it waits for remote, so the requests in flight are received first
+                        while pending:
+                            receive()
+                        self.local.urgent = priority == 0   # throttle never holds it
+                        start = time.perf_counter()
+                        try:
+                            if kind == "push" and len(infos) > 1:
+                                self.pushBundle(con, infos)
+                            elif kind == "push":
+                                self.updateRemote(con, infos[0])
+                            else:
+                                self.getRemoteFile(con, infos[0])
+                        except OSError as e:
+                            if e.filename is None:
+                                raise   # the connect failed
+                            self.skipJob(progress, job, e)
+                            job = None
+                            if kind == "pull":
+                                raise ConnectionError("Left in a frame by " + str(e)) from e
+                            continue    # a file to push is opened before it is sent
+                        self.reportProgress(progress, len(infos), size, start=start)
+                        self.doneJob(progress, job)
+                        continue
+                    names = [info.rsplit(",", 3)[0] for info in infos]
+                    if len(names) == 1 and size >= self.resumemin:
+                        self.sendMsg(con, self.MSG_CMD, self.CM_FETCH_RESUME)
+                        self.sendMsg(con, self.MSG_DATA, names[0].encode())
+                        self.sendMsg(con, self.MSG_FROM, self.getCheckpoint(filepath))
+                    elif len(names) == 1:
+                        self.sendMsg(con, self.MSG_CMD, self.CM_FETCH_FILE)
+                        self.sendMsg(con, self.MSG_DATA, names[0].encode())
+                    else:
+                        self.sendMsg(con, self.MSG_CMD, self.CM_FETCH_BATCH)
+                        self.sendMsg(con, self.MSG_LIST, "\0".join(names).encode())
+                    pending.append((job, time.perf_counter()))
+                    job = None
+                if not pending:
+                    break
+                receive()
+        except (ConnectionError, OSError) as e:
+            lost = [item[0] for item in pending] + ([job] if job is not None else [])
+            with progress["lock"]:
+                progress["jobs"].extend(lost)
+                progress["busy"] = progress["busy"] - len(lost)
+                progress["lock"].notify_all()
+            msg = "Transfer on a connect failed, " + str(len(lost)) + " jobs given back:" + str(e)
+            print(msg)
+            self.logger.error(msg)
+
+
+    def skipJob(self, progress, job, error):
+        """Mark job taken by runTransfer done without its files, which failed by error."""
+
+        with progress["lock"]:
+            progress["skipped"] = progress["skipped"] + len(job[2])
+        msg = "Skip " + str(len(job[2])) + " files of a failed job:" + str(error)
+        print(msg)
+        self.logger.error(msg)
+        self.doneJob(progress, job)
+
+
+    def doneJob(self, progress, job):
+        """Mark job taken by runTransfer done, wake the connects waiting for jobs."""
+
+        with progress["lock"]:
+            progress["busy"] = progress["busy"] - 1
+            progress["lock"].notify_all()
+
+
+    def recvJob(self, con, job, start, progress):
+        """Receive and save the files of a fetch job runTransfer sent at start."""
+
+        size, kind, infos, priority = job
+        self.local.urgent = priority == 0
+        if len(infos) > 1:
+            type, length = self.recvHead(con)
+            self.saveBundle(con, length, self.remotepath, self.localpath, type)
+        else:
+            remotefile, type, filesize, mtime = infos[0].rsplit(",", 3)
+            self.saveFile(con, self.mapPath(remotefile, self.remotepath, self.localpath), 0, int(mtime))
+        self.reportProgress(progress, len(infos), size, start=start)
+
+
+    def pushBundle(self, con, infos):
+        """Push small local files of path infos to remote in one bundle."""
+
+        paths = [info.rsplit(",", 3)[0] for info in infos]
+        names = [self.mapPath(path, self.localpath, self.remotepath) for path in paths]
+        self.sendMsg(con, self.MSG_CMD, self.CM_PUSH_BUNDLE)
+        count = self.sendBundle(con, paths, names)
+        msg = "Send bundle of " + str(count) + " local files to remote."
+        self.logger.info(msg)
+        return count
+
+
+    def reportProgress(self, progress, files, size, end=False, start=None):
+        """Count transferred files, report progress and throughput every second.
+
+        start is when the request of the files was sent, each of them is
+        counted in the latency histogram of metrics.
+        """
+
+        if files:
+            self.metrics.add("files", files)
+            self.metrics.add("transfer_bytes", size)
+        if start is not None:
+            self.metrics.observe(time.perf_counter() - start, files)
+        with progress["lock"]:
+            progress["files"] = progress["files"] + files
+            progress["bytes"] = progress["bytes"] + size
+            now = time.time()
+            if not end and now - progress["report"] < 1:
+                return
+            progress["report"] = now
+            used = max(now - progress["start"], 1e-6)
+            msg = ("Transfer " + str(progress["files"]) + "/" + str(progress["total"]) + " files, "
+                   + "%.1f MB, %.1f files/s, %.1f MB/s" % (progress["bytes"] / 1e6, progress["files"] / used,
+                                                          progress["bytes"] / used / 1e6))
+        print(msg)
+        self.logger.info(msg)
+
+
+    def startSync(self):
+        """Compare local directory to the remote directory,
+        then push new local file to remote, and get new file in remote.
+        """
+        self.startMetrics()
+        if self.peers:
+            self.fanOut(self.peers, self.localpath, self.remotepath)
+            return 0
+        while self.needsync:
+            msg = "Starting file sync between " + self.clientip + " and " + self.serverip
             print(msg)
             self.logger.info(msg)
+            con = self.connect()           
+            if self.syncFolder(con) < 0:
+                con.close()
+                break
             self.needsync = False
-            self.setconfig("time","synctime",time.strftime("%Y-%m-%d %H:%M:%S",time.localtime()))
-            con.sendall(self.CM_SYNC_OVER)
+            with contextlib.suppress(OSError):  # the connect may be lost in transfer
+                self.sendMsg(con, self.MSG_CMD, self.CM_SYNC_OVER)
             con.close()
             msg = "End sync with " + self.serverip +", save new sync time to config.ini."
             print(msg)
@@ -460,6 +2623,227 @@ class FileSync():
         return 0
 
 
+    def mirrorFolder(self, con):
+        """Push what local directory has new onto remote directory, nothing is pulled.
+
+        The directory digests are walked as a full sync does. Return count
+        of difference items pushed, raise ConnectionError if some are lost.
+        """
+
+        self.metabytes = 0
+        localfolder, remotefolder = self.getTreeFolders(con)
+        diff = [(info, kind) for info, kind in self.getDiff(localfolder, remotefolder)
+                if kind == "only in local" or kind == "new in local"]
+        if diff and self.transferDiff(con, diff) < 0:
+            raise ConnectionError("Some files are not pushed.")
+        return len(diff)
+
+
+    def planFanout(self, peers, fanout, degree):
+        """Return [(peer, peers it relays to)] of the peers pushed to directly.
+
+        star pushes to every peer. chain pushes to the first, which relays
+        to the rest. tree pushes to the first degree peers, each relays to
+        its share of the rest the same way, so the source sends degree
+        copies however many peers there are.
+        """
+
+        if fanout == "chain":
+            return [(peers[0], peers[1:])] if peers else []
+        if fanout == "tree":
+            return [(peers[i], peers[degree + i::degree]) for i in range(min(degree, len(peers)))]
+        return [(peer, []) for peer in peers]
+
+
+    def fanOut(self, peers, source, root, fanout=None, degree=None):
+        """Push folder source to peers by fanout, return count of peers reached.
+
+        root is the folder on a peer given without one. Peers pushed to
+        directly are dealt at once, each in its own thread, and each
+        relays on before it answers, so this returns when all are done.
+        """
+
+        fanout = fanout or self.fanout
+        degree = degree or self.degree
+        plan = self.planFanout(peers, fanout, degree)
+        msg = ("Push " + source + " to " + str(len(peers)) + " peers by " + fanout
+               + ", " + str(len(plan)) + " directly.")
+        print(msg)
+        self.logger.info(msg)
+        reached = [0] * len(plan)
+
+        def push(i, peer, relay):
+            reached[i] = self.pushPeer(peer, relay, source, root, fanout, degree)
+
+        threads = [threading.Thread(target=push, args=(i, peer, relay)) for i, (peer, relay) in enumerate(plan)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        msg = "Push " + source + " reached " + str(sum(reached)) + " of " + str(len(peers)) + " peers."
+        print(msg)
+        self.logger.info(msg)
+        return sum(reached)
+
+
+    def checkRelay(self, root, peers):
+        """Return why a client may not have root relayed to peers, or "" if it may.
+
+        root must be the local folder or under it. A peer must be one of
+        the peers of list, or of relay in [peers] by address or by host.
+        """
+
+        folder = os.path.realpath(self.localpath)
+        path = os.path.realpath(root)
+        if path != folder and not path.startswith(folder.rstrip(os.sep) + os.sep):
+            return "folder " + root + " is out of " + self.localpath
+        allowed = set(self.relays) | {peer.partition("=")[0] for peer in self.peers}
+        for peer in peers:
+            addr = peer.partition("=")[0]
+            if addr not in allowed and addr.rsplit(":", 1)[0] not in allowed:
+                return "peer " + addr + " is not in [peers] of config"
+        return ""
+
+
+    def pushPeer(self, peer, relay, source, root, fanout, degree):
+        """Mirror folder source onto peer, then have it relay to peers of relay.
+
+        Return count of peers reached, the peer itself and those it relayed to.
+        """
+
+        addr, sep, peerroot = peer.partition("=")
+        host, port = addr.rsplit(":", 1)
+        sync = FileSync(self.configfile)    # connects and paths of its own
+        sync.localpath = source
+        sync.remotepath = peerroot or root
+        sync.serverip = host
+        sync.port = int(port)
+        sync.index = self.getIndex()    # same local folder, share the index
+        sync.indexlock = self.indexlock
+        sync.throttle = self.throttle
+        sync.diskslots = self.diskslots
+        sync.tlsclient = self.tlsclient     # sessions belong to the context they are made by
+        sync.tlssessions = self.tlssessions
+        con = sync.connect()
+        if con is None:
+            return 0
+        try:
+            count = sync.mirrorFolder(con)
+            reached = 1
+            if relay:
+                sync.sendMsg(con, self.MSG_CMD, self.CM_RELAY)
+                sync.sendMsg(con, self.MSG_DATA, "\0".join([fanout, str(degree), sync.remotepath] + relay).encode())
+                type, answer = sync.recvMsg(con)
+                if type == self.MSG_ERR:
+                    msg = "Peer " + peer + " does not relay:" + answer.decode()
+                    print(msg)
+                    self.logger.error(msg)
+                else:
+                    reached = reached + int(answer)
+            sync.sendMsg(con, self.MSG_CMD, self.CM_SYNC_OVER)
+            con.settimeout(self.readtimeout)
+            con.recv(1)     # remote closes it when all pushed on it is saved
+        except (ConnectionError, OSError) as e:
+            msg = "Push to peer " + peer + " failed:" + str(e)
+            print(msg)
+            self.logger.error(msg)
+            return 0
+        finally:
+            con.close()
+        msg = "Push " + str(count) + " items to peer " + peer + ", " + str(reached) + " peers reached."
+        print(msg)
+        self.logger.info(msg)
+        return reached
+
+
+    def getWatcher(self, folder):
+        """Return a watcher of folder, by inotify if possible, otherwise by polling."""
+
+        if self.watchmethod != "poll" and sys.platform.startswith("linux"):
+            try:
+                return InotifyWatcher(folder)
+            except OSError as e:
+                msg = "Can't watch " + folder + " by inotify, use polling:" + str(e)
+                print(msg)
+                self.logger.error(msg)
+        return PollWatcher(self, folder, self.pollinterval)
+
+
+    def pushPath(self, con, path):
+        """Push one changed local path to remote, skip it if gone or written by sync."""
+
+        if path.endswith(self.TRANSIENT):
+            return 0    # being received from remote
+        try:
+            st = os.stat(path)
+        except OSError:
+            return -1   # removed, deletion is not synced
+        if os.path.isdir(path):
+            info = path + ",d," + str(st.st_size) + "," + str(int(st.st_mtime))
+        else:
+            if self.written.pop(path, None) == st.st_mtime_ns:
+                return 0    # received from remote, nothing new
+            info = path + ",f," + str(st.st_size) + "," + str(int(st.st_mtime))
+        return self.updateRemote(con, info)
+
+
+    def startWatch(self):
+        """Run sync as a daemon, push local changes as soon as they happen.
+
+        Change events of localpath are debounced and coalesced into a dirty
+        path queue, only those paths are pushed over one long lived connect.
+        A full sync of syncFolder runs at start, after reconnect or event
+        overflow, and every fullsync seconds as a safety net. While idle, a
+        CM_SEND_OVER is sent every half idletimeout, so remote keeps the
+        connect.
+        """
+
+        self.startMetrics()
+        self.written = {}
+        watcher = self.getWatcher(self.localpath)
+        msg = "Watching " + self.localpath + " by " + type(watcher).__name__
+        print(msg)
+        self.logger.info(msg)
+        con = None
+        lastfull = 0
+        lastsend = 0    # time the connect was last used
+        dirty = {}  # path -> time of last event
+        while True:
+            if con is None:
+                con = self.connect()
+                if con is None:
+                    time.sleep(self.pollinterval)
+                    continue
+                lastfull = 0    # changes may be lost while disconnected
+            try:
+                if watcher.overflow or time.time() - lastfull >= self.fullsync:
+                    watcher.overflow = False
+                    self.syncFolder(con)
+                    lastfull = time.time()
+                    lastsend = lastfull
+                if dirty:
+                    timeout = self.debounce
+                else:
+                    timeout = max(0, min(lastfull + self.fullsync, lastsend + self.idletimeout / 2) - time.time())
+                for path in watcher.read(timeout):
+                    dirty[path] = time.time()
+                now = time.time()
+                ready = sorted(path for path, t in dirty.items() if now - t >= self.debounce)
+                for path in ready:  # parent directory comes before its children
+                    del dirty[path]
+                    self.pushPath(con, path)
+                    lastsend = now
+                if now - lastsend >= self.idletimeout / 2:
+                    self.sendMsg(con, self.MSG_CMD, self.CM_SEND_OVER)   # keep alive
+                    lastsend = now
+            except (ConnectionError, OSError) as e:
+                msg = "Lost connect with " + self.serverip + ":" + str(e)
+                print(msg)
+                self.logger.error(msg)
+                con.close()
+                con = None
+
+
     def startServer(self):
         """Start file sync server, receive client's sync request and deal.
         
@@ -468,90 +2852,772 @@ class FileSync():
         The second is send files which need sync to client.
         The thired is receive the file which pushed by client and save it. 
         The fourth is receive the directory which pushed by client and create it.
+        Each client is served by its own thread, up to maxconn clients at once.
         """
 
         server = socket.socket(socket.AF_INET,socket.SOCK_STREAM)
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         server.bind((self.serverip,self.port))
-        server.listen(1)    # only allow one client connect
+        server.listen(self.maxconn)
+        self.startMetrics()
         msg = "File sync service is started on " + self.serverip +", waiting for remote computer connect."
         print(msg)
         self.logger.info(msg)
+        slots = threading.BoundedSemaphore(self.maxconn)
         # Deal sync request until stop server
         while True:
             con,addr = server.accept()
-            if con: # receive client connect
-                msg = "Client " + addr[0] + " is connected."
+            con = self.wrapSocket(con, server_side=True)
+            if not slots.acquire(blocking=False):
+                msg = "Too many clients, refuse " + addr[0] + "."
                 print(msg)
-                self.logger.info(msg)
-                # Deal sync command until client close connect.
-                while True:
-                    recv = con.recv(1024)
-                    if recv == self.CM_FETCH_DIR: 
-                        msg = "Receive comand of fetch directory"  
-                        print(msg)
-                        self.logger.info(msg)
-                        con.sendall(self.CM_FETCH_TIME)
-                        while True:  
-                            recv = con.recv(4)
-                            synctime = int.from_bytes(recv,byteorder="little")
-                            # get details of directory which need sync.
-                            folderinfo = self.getFolder(self.localpath,synctime)
-                            self.sendFolder(con,folderinfo) #send directory details to client
-                            msg = "Send details of request directory to client."
-                            self.logger.info(msg)
-                            break
-                        continue
-                    if recv == self.CM_FETCH_FILE:
-                        msg ="Receive command of fetch file"
-                        print(msg)
-                        self.logger.info(msg)
-                        con.sendall(self.CM_FETCH_NAME)
-                        while True:
-                            filepath = con.recv(1024).decode()
-                            if filepath: 
-                                #print(filepath)
-                                break
-                        self.sendFile(con,filepath)
-                        continue
-                    if recv == self.CM_PUSH_FILE:
-                        msg="Receive command of push file"
+                self.logger.error(msg)
+                if not isinstance(con, ssl.SSLSocket):  # TLS would hold accept for the handshake
+                    try:
+                        self.sendMsg(con, self.MSG_ERR, msg.encode())
+                    except OSError:
+                        pass
+                con.close()
+                continue
+            t = threading.Thread(target=self.serveClient, args=(con, addr, slots), daemon=True)
+            t.start()
+        return 0
+
+
+    def serveClient(self, con, addr, slots=None):
+        """Deal sync commands of one client until it sends sync over or goes away.
+
+        The client is dropped if it sends no command in idletimeout seconds,
+        or a request stalls for readtimeout seconds.
+        """
+
+        con.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        trees = set()   # roots whose digests are brought up to date for this client
+        msg = "Client " + addr[0] + " is connected."
+        print(msg)
+        self.logger.info(msg)
+        try:
+            if isinstance(con, ssl.SSLSocket):
+                con.settimeout(self.readtimeout)
+                con.do_handshake()  # a client without a cert signed by ca is refused here
+            # Deal sync command until client close connect.
+            while True:
+                con.settimeout(self.idletimeout)
+                type, recv = self.recvMsg(con)
+                con.settimeout(self.readtimeout)
+                if type != self.MSG_CMD:
+                    continue
+                if recv == self.CM_HELLO:
+                    type, codec = self.recvMsg(con)
+                    codec = codec.decode()
+                    if self.codec == "none" or codec not in self.CODECS:
+                        codec = "none"
+                    elif codec == "zstd" and zstandard is None:
+                        codec = "zlib"
+                    if codec in self.CODECS:
+                        self.codecs[con] = codec
+                    self.sendMsg(con, self.MSG_DATA, codec.encode())
+                    continue
+                if recv == self.CM_FETCH_DIR: 
+                    msg = "Receive comand of fetch directory"  
+                    print(msg)
+                    self.logger.info(msg)
+                    type, recv = self.recvMsg(con)
+                    synctime = int.from_bytes(recv,byteorder="little")
+                    # get details of directory which need sync.
+                    folderinfo = self.getFolder(self.localpath,synctime)
+                    self.sendListing(con,folderinfo) #send directory details to client
+                    msg = "Send details of request directory to client."
+                    self.logger.info(msg)
+                    continue
+                if recv == self.CM_FETCH_TREE:
+                    type, dirs = self.recvMsg(con)
+                    dirs = dirs.decode().split("\0")
+                    if not trees:   # the first request is the root of the tree
+                        self.updateTree(dirs[0])
+                        trees.add(dirs[0])
+                    self.sendFolder(con, self.listTree(dirs))
+                    continue
+                if recv == self.CM_FETCH_HASH:
+                    type, names = self.recvMsg(con)
+                    hashes = []
+                    for name in names.decode().split("\0"):
+                        try:
+                            hashes.append(self.getHash(name).hex())
+                        except OSError:
+                            hashes.append("")
+                    self.sendFolder(con, hashes)
+                    continue
+                if recv == self.CM_FETCH_SIZE:
+                    type, root = self.recvMsg(con)
+                    type, sizes = self.recvMsg(con)
+                    self.sendFolder(con, self.listSize(root.decode(), [int(size) for size in sizes.decode().split("\0")]))
+                    continue
+                if recv == self.CM_COPY_FILE:
+                    type, data = self.recvMsg(con)
+                    src, filepath = data.decode().split("\0")
+                    filename, type, size, mtime = filepath.rsplit(",", 3)
+                    try:
+                        with self.getPathLock(filename):
+                            self.copyFile(src, filename, int(mtime))
+                    except OSError as e:
+                        msg = "Copy file " + src + " failed:" + str(e)
                         print(msg)
-                        self.logger.info(msg)
-                        con.sendall(self.CM_FETCH_NAME)
-                        while True:
-                            filepath = con.recv(1024).decode()
-                            print(filepath)
-                            if filepath:
-                                self.recvFile(con,filepath)
-                                msg ="Get the file and save it."
-                                self.logger.info(msg)
-                                break
+                        self.logger.error(msg)
+                        self.sendMsg(con, self.MSG_ERR, msg.encode())
                         continue
-                    if recv == self.CM_PUSH_DIR:
-                        msg="Receive command of push directory."
+                    self.sendMsg(con, self.MSG_DATA, b"")
+                    continue
+                if recv == self.CM_FETCH_RESUME:
+                    type, filepath = self.recvMsg(con)
+                    type, offer = self.recvMsg(con)
+                    self.sendFile(con, filepath.decode(), offer=offer)
+                    continue
+                if recv == self.CM_FETCH_FILE:
+                    msg ="Receive command of fetch file"
+                    self.logger.info(msg)
+                    type, filepath = self.recvMsg(con)
+                    self.sendFile(con,filepath.decode())
+                    continue
+                if recv == self.CM_FETCH_BATCH:
+                    msg ="Receive command of fetch batch of files"
+                    self.logger.info(msg)
+                    type, names = self.recvMsg(con)
+                    self.sendBundle(con, names.decode().split("\0"))
+                    continue
+                if recv == self.CM_PUSH_BUNDLE:
+                    msg ="Receive command of push bundle of files"
+                    self.logger.info(msg)
+                    type, length = self.recvHead(con)
+                    self.saveBundle(con, length, type=type)
+                    continue
+                if recv == self.CM_FETCH_DELTA:
+                    msg ="Receive command of fetch delta of file"
+                    self.logger.info(msg)
+                    type, filepath = self.recvMsg(con)
+                    type, signature = self.recvMsg(con)
+                    self.sendFile(con,filepath.decode(),signature)
+                    continue
+                if recv == self.CM_PUSH_FILE or recv == self.CM_PUSH_DELTA:
+                    msg="Receive command of push file"
+                    self.logger.info(msg)
+                    type, filepath = self.recvMsg(con)
+                    filepath = filepath.decode()
+                    with self.getPathLock(filepath.rsplit(",", 3)[0]):
+                        self.recvFile(con,filepath,delta=(recv == self.CM_PUSH_DELTA))
+                    msg ="Get the file and save it."
+                    self.logger.info(msg)
+                    continue
+                if recv == self.CM_PUSH_DIR:
+                    msg="Receive command of push directory."
+                    self.logger.info(msg)
+                    type, filepath = self.recvMsg(con)
+                    filepath = filepath.decode()
+                    with self.getPathLock(filepath):
+                        self.recvDir(filepath)
+                    self.logger.info("get the dir name.")
+                    continue
+                if recv == self.CM_RELAY:
+                    type, data = self.recvMsg(con)
+                    fanout, degree, root, *peers = data.decode().split("\0")
+                    error = self.checkRelay(root, peers)
+                    if error:
+                        msg = "Refuse relay of " + addr[0] + ", " + error
                         print(msg)
-                        self.logger.info(msg)
-                        con.sendall(self.CM_FETCH_NAME)
-                        while True:
-                            filepath = con.recv(1024).decode()
-                            if filepath:
-                                self.recvDir(filepath)
-                                self.logger.info("get the dir name.")
-                                break
-                            continue
-                    if recv == self.CM_SEND_OVER:
+                        self.logger.error(msg)
+                        self.sendMsg(con, self.MSG_ERR, msg.encode())
                         continue
-
-                    if recv == self.CM_SYNC_OVER:
-                        con.close()
-                        msg = "End file sync with " + self.clientip + ",close connect and waiting for new sync."
-                        print(msg)
-                        self.logger.info(msg)
+                    con.settimeout(None)    # the client waits for all the relays
+                    reached = self.fanOut(peers, root, root, fanout, int(degree))
+                    self.sendMsg(con, self.MSG_DATA, str(reached).encode())
+                    continue
+                if recv == self.CM_SEND_OVER:
+                    continue
+
+                if recv == self.CM_SYNC_OVER:
+                    msg = "End file sync with " + addr[0] + ",close connect and waiting for new sync."
+                    print(msg)
+                    self.logger.info(msg)
+                    with self.configlock:
                         self.setconfig("time","synctime",time.strftime("%Y-%m-%d %H:%M:%S",time.localtime()))
-                        break
-              
+                    self.collectVersions()  # chunks of versions dropped by the pushes
+                    break
+        except (ConnectionError, OSError) as e:
+            msg = "Client " + addr[0] + " is disconnected before sync over:" + str(e)
+            print(msg)
+            self.logger.error(msg)
+        finally:
+            con.close()
+            if slots is not None:
+                slots.release()
         return 0
+
+
+    def getPathLock(self, path):
+        """Return the lock serializing writes of path across clients."""
+
+        return self.pathlocks[hash(path) % len(self.pathlocks)]
     
+
+class InotifyWatcher():
+    """Watch a directory tree by linux inotify through ctypes.
+
+    read() returns the paths changed since last call. overflow is set when
+    the kernel dropped events, then the caller should do a full sync.
+    """
+
+    IN_ATTRIB = 0x4
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_Q_OVERFLOW = 0x4000
+    IN_IGNORED = 0x8000
+    IN_ISDIR = 0x40000000
+    EVENT = struct.Struct("iIII")   # wd, mask, cookie, len of name
+
+    def __init__(self, folder):
+        """Watch every directory under folder, raise OSError if inotify fails."""
+
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.libc = libc
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.mask = (self.IN_ATTRIB | self.IN_CLOSE_WRITE | self.IN_MOVED_FROM
+                     | self.IN_MOVED_TO | self.IN_CREATE | self.IN_DELETE)
+        self.dirs = {}  # watch descriptor -> directory
+        self.overflow = False
+        self.addTree(folder)
+
+
+    def addTree(self, folder):
+        """Watch folder and its sub directories, return paths found in them."""
+
+        found = []
+        for root, subs, files in os.walk(folder):
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(root), self.mask)
+            if wd < 0:
+                raise OSError(ctypes.get_errno(), "inotify_add_watch failed on " + root)
+            self.dirs[wd] = root
+            found.extend(os.path.join(root, name) for name in subs + files)
+        return found
+
+
+    def read(self, timeout):
+        """Wait up to timeout seconds for events, return list of changed paths."""
+
+        changed = []
+        ready = select.select([self.fd], [], [], timeout)[0]
+        while ready:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                break
+            pos = 0
+            while pos < len(data):
+                wd, mask, cookie, length = self.EVENT.unpack_from(data, pos)
+                name = data[pos + self.EVENT.size:pos + self.EVENT.size + length].rstrip(b"\0")
+                pos = pos + self.EVENT.size + length
+                if mask & self.IN_Q_OVERFLOW:
+                    self.overflow = True
+                    continue
+                if mask & self.IN_IGNORED:
+                    self.dirs.pop(wd, None)
+                    continue
+                if wd not in self.dirs:
+                    continue
+                path = os.path.join(self.dirs[wd], os.fsdecode(name))
+                changed.append(path)
+                if mask & self.IN_ISDIR and mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                    try:    # files may be created before the new watch
+                        changed.extend(self.addTree(path))
+                    except OSError:
+                        self.overflow = True
+        return changed
+
+
+class PollWatcher():
+    """Watch a directory tree by polling the manifest index of FileSync.
+
+    It has the same read() and overflow as InotifyWatcher.
+    """
+
+    def __init__(self, sync, folder, interval):
+        """Poll folder of sync every interval seconds."""
+
+        self.sync = sync
+        self.folder = folder
+        self.interval = interval
+        self.overflow = False
+        self.lastpoll = time.time()
+        sync.updateIndex(folder)
+
+
+    def read(self, timeout):
+        """Wait up to timeout seconds for next poll, return list of changed paths."""
+
+        wait = self.lastpoll + self.interval - time.time()
+        if wait > timeout:
+            time.sleep(timeout)
+            return []
+        time.sleep(max(0, wait))
+        self.lastpoll = time.time()
+        changed = []
+        self.sync.updateIndex(self.folder, changes=changed)
+        return changed
+
+
+class PartialFile():
+    """Write a partial file being received and keep a checkpoint of it.
+
+    Every write updates the hash of content. After every checkpoint bytes
+    the file is flushed to disk and the checkpoint file is replaced with
+    "offset,hash of content up to offset,hash of whole file".
+    """
+
+    def __init__(self, fp, h, ckptfile, digest, checkpoint):
+        """Wrap opened fp whose content so far is hashed in h."""
+
+        self.fp = fp
+        self.h = h
+        self.ckptfile = ckptfile
+        self.digest = digest
+        self.checkpoint = checkpoint
+        self.offset = fp.tell()
+        self.saved = self.offset
+
+
+    def write(self, data):
+        """Write data to file, save a checkpoint if enough is written since last."""
+
+        n = self.fp.write(data)
+        self.h.update(data)
+        self.offset = self.offset + n
+        if self.offset - self.saved >= self.checkpoint:
+            self.save()
+        return n
+
+
+    def save(self):
+        """Flush the file to disk and save the checkpoint of it."""
+
+        self.fp.flush()
+        os.fsync(self.fp.fileno())
+        with open(self.ckptfile + ".tmp", "w", encoding="utf-8") as f:
+            f.write(str(self.offset) + "," + self.h.hexdigest() + "," + self.digest.hex())
+        os.replace(self.ckptfile + ".tmp", self.ckptfile)
+        self.saved = self.offset
+
+
+    def close(self):
+        """Close the file."""
+
+        self.fp.close()
+
+
+class Listing():
+    """Compact listing of a folder, path info kept in columns instead of strings.
+
+    Each directory is interned once in dirs. An entry keeps the id of its
+    directory, the length of its name in the shared names buffer, and its
+    type, size and mtime in parallel arrays, about 23 bytes and the name.
+    Paths are relative with "/" separator, "" is the root itself.
+    """
+
+    # count of new directories, count of entries, bytes of the directories
+    HEAD = struct.Struct("<III")
+
+    def __init__(self):
+        """Make an empty listing."""
+
+        self.dirs = [""]    # relative path of directory by id
+        self.dirids = {"": 0}
+        self.parents = array.array("I")     # directory id of entry
+        self.lens = array.array("H")        # length of name of entry
+        self.names = bytearray()
+        self.types = bytearray()
+        self.sizes = array.array("q")
+        self.mtimes = array.array("q")
+
+
+    def __len__(self):
+        return len(self.types)
+
+
+    def __iter__(self):
+        """Yield (relative path, type, size, mtime) of entries."""
+
+        start = 0
+        for parent, n, type, size, mtime in zip(self.parents, self.lens, self.types, self.sizes, self.mtimes):
+            name = self.names[start:start + n].decode()
+            start = start + n
+            dir = self.dirs[parent]
+            yield (dir + "/" + name if dir and name else dir or name), chr(type), size, mtime
+
+
+    def getDir(self, dir):
+        """Return the id of dir, interned on first use."""
+
+        id = self.dirids.get(dir)
+        if id is None:
+            id = len(self.dirs)
+            self.dirs.append(dir)
+            self.dirids[dir] = id
+        return id
+
+
+    def append(self, path, type, size, mtime):
+        """Add an entry of relative path."""
+
+        dir, sep, name = path.rpartition("/")
+        name = name.encode()
+        self.parents.append(self.getDir(dir))
+        self.lens.append(len(name))
+        self.names += name
+        self.types.append(ord(type))
+        self.sizes.append(size)
+        self.mtimes.append(mtime)
+
+
+    def offsets(self):
+        """Return the start of name of each entry in names, and the end of last."""
+
+        return array.array("Q", itertools.accumulate(self.lens, initial=0))
+
+
+    def path(self, i, offsets):
+        """Return the relative path of entry i."""
+
+        name = self.names[offsets[i]:offsets[i + 1]].decode()
+        dir = self.dirs[self.parents[i]]
+        return dir + "/" + name if dir and name else dir or name
+
+
+    def groups(self):
+        """Return the entry ids in each directory, by directory id."""
+
+        groups = [array.array("I") for dir in self.dirs]
+        for i, parent in enumerate(self.parents):
+            groups[parent].append(i)
+        return groups
+
+
+    def frames(self, count):
+        """Yield the wire payload of every count entries.
+
+        A payload is HEAD, the directories first used by its entries
+        separated by "\0", then the columns of types, parents, lens, sizes
+        and mtimes little endian, and the names. Unpacked in order, the
+        receiver gets the same directory ids.
+        """
+
+        sent = 1    # the root is known by both sides
+        pos = 0
+        for start in range(0, len(self), count):
+            stop = min(start + count, len(self))
+            parents = self.parents[start:stop]
+            known = max(max(parents) + 1, sent)
+            dirs = "\0".join(self.dirs[sent:known]).encode()
+            lens = self.lens[start:stop]
+            end = pos + sum(lens)
+            columns = [parents, lens, self.sizes[start:stop], self.mtimes[start:stop]]
+            if sys.byteorder == "big":
+                for column in columns:
+                    column.byteswap()
+            yield b"".join([self.HEAD.pack(known - sent, stop - start, len(dirs)), dirs,
+                            self.types[start:stop]] + [column.tobytes() for column in columns]
+                           + [self.names[pos:end]])
+            sent = known
+            pos = end
+
+
+    def unpack(self, data):
+        """Add the entries of one wire payload, without a string for each entry."""
+
+        ndirs, count, size = self.HEAD.unpack_from(data)
+        pos = self.HEAD.size
+        if ndirs:
+            for dir in bytes(data[pos:pos + size]).decode().split("\0"):
+                self.dirids[dir] = len(self.dirs)
+                self.dirs.append(dir)
+        pos = pos + size
+        self.types += data[pos:pos + count]
+        pos = pos + count
+        start = len(self.parents)
+        for column in (self.parents, self.lens, self.sizes, self.mtimes):
+            part = array.array(column.typecode, data[pos:pos + count * column.itemsize])
+            if sys.byteorder == "big":
+                part.byteswap()
+            column.extend(part)
+            pos = pos + count * column.itemsize
+        self.names += data[pos:]
+        if count and (max(self.parents[start:]) >= len(self.dirs)
+                      or sum(self.lens[start:]) != len(data) - pos):
+            raise ValueError("Bad listing frame.")
+
+
+class Metrics():
+    """Counters, phase times and file latency histogram of sync cycles.
+
+    Totals count since start and are served by MetricsHandler, the cycle
+    ones are reset by begin and summarized by end.
+    """
+
+    BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60)   # upper bounds of file latency in seconds
+    COUNTERS = ("files", "transfer_bytes", "metadata_bytes", "tls_handshakes", "tls_resumed")
+
+    def __init__(self):
+        """Make empty metrics."""
+
+        self.lock = threading.Lock()
+        self.totals = dict.fromkeys(self.COUNTERS + ("cycles",), 0)
+        self.totalhist = [0] * (len(self.BUCKETS) + 1)
+        self.totalsum = 0.0
+        self.last = {}  # summary of last cycle
+        self.begin()
+
+
+    def begin(self):
+        """Start a new cycle."""
+
+        with self.lock:
+            self.start = time.perf_counter()
+            self.counts = dict.fromkeys(self.COUNTERS, 0)
+            self.phases = {}
+            self.hist = [0] * (len(self.BUCKETS) + 1)
+            self.latencysum = 0.0
+
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Add the time spent in the with block to phase name."""
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.phases[name] = self.phases.get(name, 0.0) + time.perf_counter() - start
+
+
+    def add(self, name, value):
+        """Add value to counter name."""
+
+        with self.lock:
+            self.counts[name] = self.counts[name] + value
+            self.totals[name] = self.totals[name] + value
+
+
+    def observe(self, seconds, count=1):
+        """Count count files which took seconds each."""
+
+        i = bisect.bisect_left(self.BUCKETS, seconds)
+        with self.lock:
+            self.hist[i] = self.hist[i] + count
+            self.totalhist[i] = self.totalhist[i] + count
+            self.latencysum = self.latencysum + seconds * count
+            self.totalsum = self.totalsum + seconds * count
+
+
+    def quantile(self, q):
+        """Return the bucket bound q of the files of this cycle took at most.
+
+        Return 0 if no file, None if over the last bound.
+        """
+
+        count = sum(self.hist)
+        seen = 0
+        for bound, n in zip(self.BUCKETS + (None,), self.hist):
+            seen = seen + n
+            if n and seen >= q * count:
+                return bound
+        return 0
+
+
+    def end(self):
+        """End the cycle, return its summary."""
+
+        with self.lock:
+            used = time.perf_counter() - self.start
+            transfer = self.phases.get("transfer", 0.0)
+            count = sum(self.hist)
+            summary = {"time": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime()),
+                       "seconds": used,
+                       "phases": dict(self.phases)}
+            summary.update(self.counts)
+            summary["files_per_second"] = self.counts["files"] / transfer if transfer else 0.0
+            summary["mb_per_second"] = self.counts["transfer_bytes"] / transfer / 1e6 if transfer else 0.0
+            summary["file_seconds"] = {
+                "buckets": {str(bound): n for bound, n in zip(self.BUCKETS + ("+Inf",), self.hist)},
+                "count": count, "sum": self.latencysum,
+                "p50": self.quantile(0.5), "p99": self.quantile(0.99)}
+            self.totals["cycles"] = self.totals["cycles"] + 1
+            self.last = summary
+        return summary
+
+
+    def exposition(self):
+        """Return the metrics in Prometheus text exposition format."""
+
+        lines = []
+        with self.lock:
+            for name in self.COUNTERS + ("cycles",):
+                lines.append("# TYPE filesync_" + name + "_total counter")
+                lines.append("filesync_" + name + "_total " + str(self.totals[name]))
+            lines.append("# TYPE filesync_last_phase_seconds gauge")
+            for name, used in self.last.get("phases", {}).items():
+                lines.append('filesync_last_phase_seconds{phase="' + name + '"} ' + repr(used))
+            for name in ("files_per_second", "mb_per_second"):
+                lines.append("# TYPE filesync_last_" + name + " gauge")
+                lines.append("filesync_last_" + name + " " + repr(self.last.get(name, 0.0)))
+            lines.append("# TYPE filesync_file_seconds histogram")
+            seen = 0
+            for bound, n in zip(self.BUCKETS + ("+Inf",), self.totalhist):
+                seen = seen + n
+                lines.append('filesync_file_seconds_bucket{le="' + str(bound) + '"} ' + str(seen))
+            lines.append("filesync_file_seconds_sum " + repr(self.totalsum))
+            lines.append("filesync_file_seconds_count " + str(seen))
+        return "\n".join(lines) + "\n"
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    """Answer GET /metrics in Prometheus text, and /summary with the last cycle in JSON."""
+
+    def do_GET(self):
+        metrics = self.server.metrics
+        if self.path == "/metrics":
+            body = metrics.exposition().encode()
+            ctype = "text/plain; version=0.0.4"
+        elif self.path == "/summary":
+            with metrics.lock:
+                body = json.dumps(metrics.last).encode()
+            ctype = "application/json"
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", ctype)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def log_message(self, format, *args):
+        pass    # scraping is not worth a line in running.log
+
+
+class Throttle():
+    """Token bucket of bytes per second shared by the connects.
+
+    The rate is the one of the time window of now, or the base rate out of
+    all windows, 0 is no limit. Up to one second of rate is saved for a
+    burst. Bytes of urgent transfers are taken too, but never wait, so
+    they take their share from the others.
+    """
+
+    def __init__(self, rate, windows=()):
+        """Make a bucket of base rate and [(start minute, end minute, rate)] windows."""
+
+        self.base = rate
+        self.windows = list(windows)
+        self.lock = threading.Lock()
+        self.tokens = 0.0
+        self.stamp = time.monotonic()
+
+
+    def getRate(self):
+        """Return the rate of now."""
+
+        now = time.localtime()
+        minute = now.tm_hour * 60 + now.tm_min
+        for start, end, rate in self.windows:
+            if start <= minute < end or (end < start and (minute >= start or minute < end)):
+                return rate     # a window may wrap over midnight
+        return self.base
+
+
+    def take(self, n, urgent=False):
+        """Take n bytes from the bucket, wait till they are paid unless urgent."""
+
+        rate = self.getRate()
+        if not rate:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(rate, self.tokens + (now - self.stamp) * rate) - n
+            self.stamp = now
+            wait = -self.tokens / rate
+        if wait > 0 and not urgent:
+            time.sleep(wait)
+
+
+class ThrottledSocket(socket.socket):
+    """Socket whose bytes sent and received are paid to a Throttle.
+
+    throttle and local are set by FileSync.wrapSocket. Bytes of a thread
+    whose local.urgent is set never wait. Sends and receives go in pieces
+    of PIECE bytes, so a slow rate is kept smoothly.
+    """
+
+    PIECE = 65536
+
+    def sendall(self, data, flags=0):
+        view = memoryview(data).cast("B")
+        for start in range(0, len(view), self.PIECE):
+            piece = view[start:start + self.PIECE]
+            self.throttle.take(len(piece), getattr(self.local, "urgent", False))
+            super().sendall(piece, flags)
+
+
+    def send(self, data, flags=0):
+        n = super().send(memoryview(data).cast("B")[:self.PIECE], flags)
+        self.throttle.take(n, getattr(self.local, "urgent", False))
+        return n
+
+
+    def recv_into(self, buffer, nbytes=0, flags=0):
+        nbytes = min(nbytes or len(memoryview(buffer).cast("B")), self.PIECE)
+        n = super().recv_into(buffer, nbytes, flags)
+        self.throttle.take(n, getattr(self.local, "urgent", False))
+        return n
+
+
+    def recv(self, bufsize, flags=0):
+        data = super().recv(min(bufsize, self.PIECE), flags)
+        self.throttle.take(len(data), getattr(self.local, "urgent", False))
+        return data
+
+
+class ThrottledSSLSocket(ssl.SSLSocket):
+    """SSLSocket whose bytes are paid to a Throttle, as ThrottledSocket.
+
+    sendall of SSLSocket goes by send, so only send and the receives are
+    paced. The bytes paid are those of the content, not of TLS records.
+    """
+
+    PIECE = ThrottledSocket.PIECE
+
+    def send(self, data, flags=0):
+        n = super().send(memoryview(data).cast("B")[:self.PIECE], flags)
+        self.throttle.take(n, getattr(self.local, "urgent", False))
+        return n
+
+
+    def recv_into(self, buffer, nbytes=0, flags=0):
+        nbytes = min(nbytes or len(memoryview(buffer).cast("B")), self.PIECE)
+        n = super().recv_into(buffer, nbytes, flags)
+        self.throttle.take(n, getattr(self.local, "urgent", False))
+        return n
+
+
+    def recv(self, bufsize, flags=0):
+        data = super().recv(min(bufsize, self.PIECE), flags)
+        self.throttle.take(len(data), getattr(self.local, "urgent", False))
+        return data
+
+
 if __name__ == "__main__":
     s = FileSync()
     s.startServer()
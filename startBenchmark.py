@@ -0,0 +1,1015 @@
+"""
+Benchmarks of FileSync, run as: python startBenchmark.py [scenario] [sizes]
+
+diff -- time getDiff on synthetic listings, sizes like 1k,10k,100k,1m.
+listing -- send synthetic listings over a loopback socket.
+memory -- bytes per entry of listings kept as path info strings and as Listing.
+transfer -- send files of sizes like 1m,100m,5g over a loopback socket.
+index -- scan trees of 10k,100k files cold and unchanged with the manifest index.
+server -- load the server with 50 clients at once over loopback.
+bundle -- sync 100k files of 1 KB one by one and in bundles over loopback,
+with fsync of received files off and on.
+compress -- sync a 100m log and a random file with each codec over loopback.
+tree -- full resync of 100k files with 5 changed, flat listing against digest walk.
+scan -- scan 20k files with 1 ms added to every stat, by 1 and by many scanners.
+rename -- count bytes on wire to sync 200 files of 256 KB after a directory
+is renamed on each side, with and without rename detection.
+schedule -- pull a 64 MB file and 50 recently changed small files under
+a bandwidth cap of 8 MB/s, report the cap kept and when the small ones arrived.
+delta -- send the delta of a 100 KB insert, delete and prepend in an 8 MB random
+file, check the file rebuilt and the bytes on wire.
+resume -- drop the pull of a 48 MB file half way over loopback, check the next
+sync resumes it from the checkpoint and the file matches.
+fanout -- push a tree of 200 random files up to 64 KB to 8 local servers by star,
+chain and tree fan-out, report total time and bytes the source sent.
+tls -- pull a 256 MB file and 2000 files of 1 KB in plaintext and by TLS with
+a self-signed cert over loopback, then resync 5 times, report throughput and
+the handshakes resumed.
+suite -- cold full sync, no-op resync, 1% churn and a large file over
+loopback on a synthetic tree, results as JSON. Parameters are given as
+name=value: count=10k sizes=1k:80,64k:15,1m:5 depth=3 churn=0.01
+large=256m seed=1 out=suite.json.
+"""
+
+import contextlib
+import json
+import math
+import os
+import platform
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:     # not on windows
+    resource = None
+
+import FileSync
+
+
+def parseCount(text):
+    """Turn a count like 10k or 1m into an int, or a size like 5g for bytes."""
+
+    text = text.strip().lower()
+    scale = {"k": 1000, "m": 1000000, "g": 1000000000}.get(text[-1:], 1)
+    if scale > 1:
+        text = text[:-1]
+    return int(float(text) * scale)
+
+
+def makeListing(root, count, churn=0.01, shift=0):
+    """Build a synthetic path info list with count records under root."""
+
+    now = 1700000000
+    listing = [root + ",d,4096," + str(now)]
+    for i in range(count - 1):
+        size = 1024 + i % 4096
+        mtime = now
+        if shift and i % int(1 / churn) == 0:
+            size = size + 1     # modified file
+            mtime = now + shift
+        path = root + "\\dir" + str(i // 1000) + "\\file" + str(i) + ".dat"
+        listing.append(path + ",f," + str(size) + "," + str(mtime))
+    return listing
+
+
+def benchDiff(sync, sizes):
+    """Time getDiff from small to large listings, return result rows."""
+
+    rows = []
+    for count in sizes:
+        local = sync.toListing(makeListing(sync.localpath, count), sync.localpath)
+        remote = makeListing(sync.remotepath, count, shift=60)
+        remote = remote[: len(remote) - len(remote) // 100]  # 1% only in local
+        remote = sync.toListing(remote, sync.remotepath)
+        start = time.perf_counter()
+        diff = sync.getDiff(local, remote)
+        used = time.perf_counter() - start
+        rows.append((count, len(diff), used))
+        print("diff %9d entries: %8d items in %.3fs, %.2f us/entry"
+              % (count, len(diff), used, used * 1e6 / count))
+    return rows
+
+
+def serveListing(sync, server, listing):
+    """Answer one fetch directory request on server with listing."""
+
+    con, addr = server.accept()
+    with con:
+        while True:
+            type, recv = sync.recvMsg(con)
+            if recv == sync.CM_FETCH_DIR:
+                sync.recvMsg(con)   # sync time
+                sync.sendListing(con, listing)
+            elif recv == sync.CM_SYNC_OVER:
+                break
+
+
+def benchListing(sync, sizes):
+    """Time getRemoteFolder of large manifests over loopback, return result rows."""
+
+    rows = []
+    for count in sizes:
+        listing = sync.toListing(makeListing(sync.remotepath, count), sync.remotepath)
+        server = socket.create_server(("127.0.0.1", 0))
+        t = threading.Thread(target=serveListing, args=(sync, server, listing))
+        t.start()
+        con = socket.create_connection(server.getsockname())
+        sync.metabytes = 0
+        start = time.perf_counter()
+        folder = sync.getRemoteFolder(con, sync.remotepath, 0)
+        used = time.perf_counter() - start
+        sync.sendMsg(con, sync.MSG_CMD, sync.CM_SYNC_OVER)
+        t.join()
+        con.close()
+        server.close()
+        assert list(folder) == list(listing)
+        mb = sync.metabytes / 1e6
+        rows.append((count, used))
+        print("listing %9d entries: %.3fs, %.0f entries/s, %.1f MB/s"
+              % (count, used, count / used, mb / used))
+    return rows
+
+
+def benchMemory(sync, sizes):
+    """Measure bytes per entry of a listing as path info strings and as Listing."""
+
+    rows = []
+    for count in sizes:
+        tracemalloc.start()
+        listing = makeListing(sync.remotepath, count)
+        strings = tracemalloc.get_traced_memory()[0]
+        del listing
+        tracemalloc.stop()
+        tracemalloc.start()
+        listing = sync.toListing(makeListing(sync.remotepath, count), sync.remotepath)
+        compact = tracemalloc.get_traced_memory()[0]
+        del listing
+        tracemalloc.stop()
+        rows.append((count, strings / count, compact / count))
+        print("memory %9d entries: path info %.1f bytes/entry, Listing %.1f bytes/entry"
+              % (count, strings / count, compact / count))
+    return rows
+
+
+def peakRSS():
+    """Return peak resident memory of this process in MB, or 0 if unknown."""
+
+    if resource is None:
+        return 0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        return peak / 1e6
+    return peak / 1e3
+
+
+def makeFile(path, size):
+    """Write a file of size bytes filled by a repeated random block."""
+
+    block = os.urandom(1 << 20)
+    with open(path, "wb") as fp:
+        left = size
+        while left > 0:
+            fp.write(block[:left])
+            left = left - len(block)
+
+
+def serveFile(sync, server, path):
+    """Receive one pushed file on server and save it to path."""
+
+    con, addr = server.accept()
+    with con:
+        type, command = sync.recvMsg(con)
+        sync.recvMsg(con)   # path info
+        sync.recvFile(con, path + ",f,0,0", delta=(command == sync.CM_PUSH_DELTA))
+
+
+def benchTransfer(sync, sizes):
+    """Push files of given sizes over loopback, return result rows."""
+
+    rows = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in sizes:
+            src = os.path.join(tmp, "src.dat")
+            dst = os.path.join(tmp, "dst.dat")
+            makeFile(src, size)
+            server = socket.create_server(("127.0.0.1", 0))
+            t = threading.Thread(target=serveFile, args=(sync, server, dst))
+            t.start()
+            con = socket.create_connection(server.getsockname())
+            start = time.perf_counter()
+            sync.updateRemote(con, src + ",f," + str(size) + ",0")
+            t.join()
+            used = time.perf_counter() - start
+            con.close()
+            server.close()
+            assert os.path.getsize(dst) == size
+            os.remove(src)
+            os.remove(dst)
+            rows.append((size, used, peakRSS()))
+            print("transfer %12d bytes: %.3fs, %.1f MB/s, peak RSS %.1f MB"
+                  % (size, used, size / used / 1e6, peakRSS()))
+    return rows
+
+
+def makeConfig(tmp, local, remote="", port=0, options=None):
+    """Write a config file for a FileSync in tmp, return the path of it.
+
+    options is a dict of section -> dict of extra parameters.
+    """
+
+    configfile = os.path.join(tmp, "config.ini")
+    with open(configfile, "w", encoding="utf-8") as f:
+        f.write("[host]\nclient = 127.0.0.1\nserver = 127.0.0.1\nport = " + str(port) + "\n"
+                "[folder]\nlocal = " + local + "\nremote = " + (remote or local) + "\n"
+                "[status]\nneedsync = True\n[time]\nsynctime = \n")
+        for section, values in (options or {}).items():
+            f.write("[" + section + "]\n")
+            for name, value in values.items():
+                f.write(name + " = " + str(value) + "\n")
+    return configfile
+
+
+def freePort():
+    """Return a free tcp port of loopback."""
+
+    with socket.create_server(("127.0.0.1", 0)) as server:
+        return server.getsockname()[1]
+
+
+def startServer(tmp, root, options=None):
+    """Start a FileSync server of root on loopback, return its port."""
+
+    folder = os.path.join(tmp, "server")
+    os.makedirs(folder, exist_ok=True)
+    port = freePort()
+    server = FileSync.FileSync(makeConfig(folder, root, port=port, options=options))
+    t = threading.Thread(target=server.startServer, daemon=True)
+    with contextlib.redirect_stdout(open(os.devnull, "w")):
+        t.start()
+        time.sleep(0.3)
+    return port
+
+
+def endSync(sync, con):
+    """Send sync over on con, wait until remote closes it and close it.
+
+    The server saves its sync time after sync over, so its folder must
+    not be removed before that.
+    """
+
+    with contextlib.suppress(OSError):
+        sync.sendMsg(con, sync.MSG_CMD, sync.CM_SYNC_OVER)
+        con.settimeout(60)
+        con.recv(1)     # server closes after sync over
+    con.close()
+
+
+def runSync(tmp, local, remote, port, options=None):
+    """Run one sync of local with remote over loopback, return (seconds, client)."""
+
+    folder = os.path.join(tmp, "client")
+    os.makedirs(folder, exist_ok=True)
+    client = FileSync.FileSync(makeConfig(folder, local, remote, port, options))
+    with contextlib.redirect_stdout(open(os.devnull, "w")):
+        start = time.perf_counter()
+        con = client.connect()
+        client.syncFolder(con)
+        endSync(client, con)
+        used = time.perf_counter() - start
+    return used, client
+
+
+def makeTree(root, count, size=100, width=100):
+    """Create count files of size bytes under root, width files per directory."""
+
+    data = b"x" * size
+    for i in range(count):
+        folder = os.path.join(root, "d" + str(i // width // width), "d" + str(i // width))
+        if i % width == 0:
+            os.makedirs(folder, exist_ok=True)
+        with open(os.path.join(folder, "f" + str(i)), "wb") as fp:
+            fp.write(data)
+
+
+def walkFolder(folder):
+    """Scan folder like getFolder did before the manifest index."""
+
+    folderlist = []
+    for root, subs, files in os.walk(folder):
+        folderlist.append(root + ",d," + str(os.path.getsize(root)) + "," + str(int(os.path.getmtime(root))))
+        for file in files:
+            path = os.path.join(root, file)
+            folderlist.append(path + ",f," + str(os.path.getsize(path)) + "," + str(int(os.path.getmtime(path))))
+    return folderlist
+
+
+def benchIndex(sizes):
+    """Time getFolder with a cold, an unchanged and a trusted index, return result rows."""
+
+    rows = []
+    for count in sizes:
+        with tempfile.TemporaryDirectory() as tmp:
+            root = os.path.join(tmp, "tree")
+            makeTree(root, count)
+            sync = FileSync.FileSync(makeConfig(tmp, root))
+            start = time.perf_counter()
+            walkFolder(root)
+            walk = time.perf_counter() - start
+            start = time.perf_counter()
+            sync.getFolder(root)
+            cold = time.perf_counter() - start
+            start = time.perf_counter()
+            listing = sync.getFolder(root)
+            warm = time.perf_counter() - start
+            sync.indextrust = True
+            start = time.perf_counter()
+            assert sorted(sync.getFolder(root)) == sorted(listing)
+            trusted = time.perf_counter() - start
+            sync.getIndex().close()
+            rows.append((count, walk, cold, warm, trusted))
+            print("index %9d files: os.walk %.3fs, cold index %.3fs, unchanged %.3fs, trusted %.3fs"
+                  % (count, walk, cold, warm, trusted))
+    return rows
+
+
+def runClient(sync, address, files, latency):
+    """Fetch the listing and files like a client, append request latency."""
+
+    con = socket.create_connection(address)
+    with con:
+        start = time.perf_counter()
+        sync.getRemoteFolder(con, sync.remotepath, 0)
+        latency.append(time.perf_counter() - start)
+        for path in files:
+            start = time.perf_counter()
+            sync.sendMsg(con, sync.MSG_CMD, sync.CM_FETCH_FILE)
+            sync.sendMsg(con, sync.MSG_DATA, path.encode())
+            sync.recvMsg(con)
+            latency.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        sync.sendMsg(con, sync.MSG_CMD, sync.CM_PUSH_FILE)
+        sync.sendMsg(con, sync.MSG_DATA, (files[0] + ",f,0,0").encode())
+        sync.sendMsg(con, sync.MSG_DATA, b"pushed")
+        sync.sendMsg(con, sync.MSG_CMD, sync.CM_SYNC_OVER)
+        con.recv(1)    # server closes after sync over
+        latency.append(time.perf_counter() - start)
+
+
+def benchServer(clients, count=1000, fetch=50, size=16384):
+    """Serve clients at once over loopback, report throughput and p99 latency."""
+
+    with tempfile.TemporaryDirectory() as tmp:
+        root = os.path.join(tmp, "tree")
+        makeTree(root, count, size)
+        port = freePort()
+        sync = FileSync.FileSync(makeConfig(tmp, root, port=port))
+        t = threading.Thread(target=sync.startServer, daemon=True)
+        t.start()
+        time.sleep(0.5)
+        files = sorted(sync.joinPath(root, path) for path, type, size, mtime in sync.getFolder(root) if type == "f")
+        latency = []
+        threads = []
+        start = time.perf_counter()
+        for i in range(clients):
+            picked = files[i * fetch % len(files):][:fetch]
+            client = threading.Thread(target=runClient, args=(sync, ("127.0.0.1", port), picked, latency))
+            client.start()
+            threads.append(client)
+        for client in threads:
+            client.join()
+        used = time.perf_counter() - start
+        latency.sort()
+        p50 = latency[len(latency) // 2]
+        p99 = latency[int(len(latency) * 0.99)]
+        print("server %d clients: %d requests in %.3fs, %.0f requests/s, %.1f MB/s, p50 %.1fms, p99 %.1fms"
+              % (clients, len(latency), used, len(latency) / used,
+                 clients * fetch * size / used / 1e6, p50 * 1e3, p99 * 1e3))
+        return len(latency), used, p99
+
+
+def benchBundle(count, size=1000):
+    """Pull count small files one by one and in bundles, with and without fsync, report files per second."""
+
+    rows = []
+    for name, batchsize in (("one by one", 0), ("bundle", 65536)):
+        for fsync in ("false", "true"):
+            with tempfile.TemporaryDirectory() as tmp:
+                remote = os.path.join(tmp, "remote")
+                local = os.path.join(tmp, "local")
+                makeTree(remote, count, size)
+                os.makedirs(local)
+                port = startServer(tmp, remote)
+                options = {"transfer": {"batchsize": batchsize, "fsync": fsync}}
+                used, client = runSync(tmp, local, remote, port, options)
+                rows.append((name, fsync, used))
+                print("bundle %s, fsync %s: %d files in %.3fs, %.0f files/s"
+                      % (name, fsync, count, used, count / used))
+    return rows
+
+
+def benchCompress(size):
+    """Pull a text log and a random file of size bytes with each codec, report the ratio."""
+
+    rows = []
+    codecs = ["none", "zlib", "lzma"] + (["zstd"] if FileSync.zstandard else [])
+    for codec in codecs:
+        with tempfile.TemporaryDirectory() as tmp:
+            remote = os.path.join(tmp, "remote")
+            local = os.path.join(tmp, "local")
+            os.makedirs(remote)
+            os.makedirs(local)
+            with open(os.path.join(remote, "running.log"), "w") as fp:
+                line = 0
+                while fp.tell() < size:
+                    fp.write("2024-09-01 18:10:%02d INFO Send file:/data/f%d.txt, size %d\n"
+                             % (line % 60, line, line * 37 % 100000))
+                    line = line + 1
+            makeFile(os.path.join(remote, "random.bin"), size)
+            options = {"compress": {"codec": codec}}
+            port = startServer(tmp, remote, options)
+            used, client = runSync(tmp, local, remote, port, options)
+            stats = client.compressstats
+            ratio = stats["raw"] / stats["wire"] if stats["wire"] else 1.0
+            rows.append((codec, used, ratio, stats["cpu"]))
+            print("compress %s: %.3fs, ratio %.2f, cpu %.3fs" % (codec, used, ratio, stats["cpu"]))
+    return rows
+
+
+def benchTree(count, changes=5):
+    """Full resync a tree of count files with a few changes, report metadata bytes and time."""
+
+    with tempfile.TemporaryDirectory() as tmp:
+        remote = os.path.join(tmp, "remote")
+        local = os.path.join(tmp, "local")
+        makeTree(remote, count)
+        shutil.copytree(remote, local)
+        later = time.time() + 10    # newer than the copy by more than getDiff tolerates
+        changed = [os.path.join("d0", "d" + str(i), "f" + str(i * 100)) for i in range(changes)]
+        for name in changed:
+            with open(os.path.join(remote, name), "w") as fp:
+                fp.write("changed")
+            os.utime(os.path.join(remote, name), (later, later))
+        port = startServer(tmp, remote)
+        os.makedirs(os.path.join(tmp, "flat"))
+        client = FileSync.FileSync(makeConfig(os.path.join(tmp, "flat"), local, remote, port))
+        with contextlib.redirect_stdout(open(os.devnull, "w")):
+            start = time.perf_counter()
+            con = client.connect()
+            client.getRemoteFolder(con, remote, 0)
+            endSync(client, con)
+            used = time.perf_counter() - start
+        print("tree flat listing: %d files, %d bytes of metadata in %.3fs" % (count, client.metabytes, used))
+        used, client = runSync(tmp, local, remote, port)
+        print("tree digest walk: %d files, %d bytes of metadata, sync in %.3fs" % (count, client.metabytes, used))
+        for name in changed:
+            with open(os.path.join(local, name)) as fp:
+                assert fp.read() == "changed", name + " is not synced"
+        used, client = runSync(tmp, local, remote, port)
+        print("tree digest walk unchanged: %d bytes of metadata, sync in %.3fs" % (client.metabytes, used))
+        assert client.metabytes < 1024, "unchanged resync walks below the root digest"
+
+
+def benchSchedule(size=64 << 20, rate=8 << 20, small=50):
+    """Pull a large file and small recent files with rate cap, report rate and arrival of small files."""
+
+    with tempfile.TemporaryDirectory() as tmp:
+        remote = os.path.join(tmp, "remote")
+        local = os.path.join(tmp, "local")
+        os.makedirs(local)
+        os.makedirs(os.path.join(remote, "bulk"))
+        makeFile(os.path.join(remote, "bulk", "backup.bin"), size)
+        os.makedirs(os.path.join(remote, "recent"))
+        for i in range(small):
+            with open(os.path.join(remote, "recent", "f" + str(i)), "wb") as fp:
+                fp.write(os.urandom(100000))
+        port = startServer(tmp, remote)
+        arrived = []
+
+        def watch():
+            target = os.path.join(local, "recent", "f" + str(small - 1))
+            start = time.perf_counter()
+            while not os.path.exists(target) and time.perf_counter() - start < 600:
+                time.sleep(0.01)
+            arrived.append(time.perf_counter() - start)
+
+        t = threading.Thread(target=watch)
+        t.start()
+        options = {"schedule": {"rate": rate}, "transfer": {"workers": 2}}
+        used, client = runSync(tmp, local, remote, port, options)
+        t.join()
+        print("schedule cap %.1f MB/s: %d MB in %.2fs, %.1f MB/s, %d small files arrived in %.2fs"
+              % (rate / 1e6, size >> 20, used, (size + small * 100000) / used / 1e6, small, arrived[0]))
+        return used, arrived[0]
+
+
+def makeSynthetic(root, count, sizes, depth=3, width=100, seed=1):
+    """Create count files of random content under root, return their paths.
+
+    sizes is a list of (size, weight), a file gets a size between half
+    and whole of a size picked by weight. Files go width to a directory,
+    directories are nested depth levels. Same arguments make same tree.
+    """
+
+    rng = random.Random(seed)
+    dirs = max(1, -(-count // width))
+    fanout = max(2, math.ceil(dirs ** (1 / depth)))
+    paths = []
+    for i in range(count):
+        k = i // width
+        parts = []
+        for level in range(depth):
+            parts.append("d" + str(k % fanout))
+            k = k // fanout
+        folder = os.path.join(root, *reversed(parts))
+        if i % width == 0:
+            os.makedirs(folder, exist_ok=True)
+        size = rng.choices([size for size, weight in sizes], [weight for size, weight in sizes])[0]
+        size = rng.randint(size // 2, size)
+        path = os.path.join(folder, "f" + str(i) + ".dat")
+        with open(path, "wb") as fp:
+            left = size
+            while left > 0:
+                fp.write(rng.randbytes(min(left, 1 << 20)))
+                left = left - (1 << 20)
+        paths.append(path)
+    return paths
+
+
+def churnTree(paths, churn, seed=1):
+    """Grow churn of the files by a few bytes and move their mtime ahead, return count."""
+
+    rng = random.Random(seed)
+    picked = rng.sample(paths, max(1, int(len(paths) * churn)))
+    later = time.time() + 10    # newer than the copy by more than getDiff tolerates
+    for path in picked:
+        with open(path, "ab") as fp:
+            fp.write(rng.randbytes(16))
+        os.utime(path, (later, later))
+    return len(picked)
+
+
+def runCycle(client):
+    """Run one sync cycle of client over a new connect, return (seconds, metrics summary)."""
+
+    with contextlib.redirect_stdout(open(os.devnull, "w")):
+        start = time.perf_counter()
+        con = client.connect()
+        client.syncFolder(con)
+        endSync(client, con)
+        used = time.perf_counter() - start
+    return used, client.metrics.last
+
+
+def benchSuite(count=10000, sizes="1k:80,64k:15,1m:5", depth=3, churn=0.01, large="256m",
+               seed=1, out=""):
+    """Run cold, no-op, churn and large file sync cycles over loopback, return the results.
+
+    The results are printed as JSON and saved to out if given, so runs
+    on other trees, machines or commits can be compared.
+    """
+
+    count = parseCount(str(count))
+    depth = int(depth)
+    churn = float(churn)
+    seed = int(seed)
+    large = parseCount(str(large))
+    dist = [(parseCount(size), float(weight)) for size, weight in
+            (item.split(":") for item in sizes.split(","))]
+    results = {"params": {"count": count, "sizes": sizes, "depth": depth, "churn": churn,
+                          "large": large, "seed": seed},
+               "python": platform.python_version(), "platform": platform.platform(),
+               "scenarios": {}}
+    with tempfile.TemporaryDirectory() as tmp:
+        remote = os.path.join(tmp, "remote")
+        local = os.path.join(tmp, "local")
+        os.makedirs(local)
+        start = time.perf_counter()
+        paths = makeSynthetic(remote, count, dist, depth, seed=seed)
+        results["generate_seconds"] = time.perf_counter() - start
+        results["bytes"] = sum(os.path.getsize(path) for path in paths)
+        port = startServer(tmp, remote)
+        folder = os.path.join(tmp, "client")
+        os.makedirs(folder)
+        client = FileSync.FileSync(makeConfig(folder, local, remote, port))
+        steps = [("cold", None), ("noop", None),
+                 ("churn", lambda: churnTree(paths, churn, seed)),
+                 ("large", lambda: makeSynthetic(os.path.join(remote, "large"), 1, [(large, 1)], 1, seed=seed))]
+        for name, change in steps:
+            # changes in the second of last sync are not listed, nor a cycle runs in it
+            time.sleep(1.1)
+            if change is not None:
+                change()
+            used, summary = runCycle(client)
+            phases = summary.get("phases", {})
+            results["scenarios"][name] = {
+                "seconds": used, "scan": phases.get("scan", 0.0), "diff": phases.get("diff", 0.0),
+                "transfer": phases.get("transfer", 0.0), "items": summary.get("items", 0),
+                "files": summary.get("files", 0), "transfer_bytes": summary.get("transfer_bytes", 0),
+                "metadata_bytes": summary.get("metadata_bytes", 0),
+                "files_per_second": summary.get("files_per_second", 0.0),
+                "mb_per_second": summary.get("mb_per_second", 0.0),
+                "file_p50": summary.get("file_seconds", {}).get("p50"),
+                "file_p99": summary.get("file_seconds", {}).get("p99")}
+        client.getIndex().close()
+    text = json.dumps(results, indent=2)
+    print(text)
+    if out:
+        with open(out, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    return results
+
+
+def countingProxy(port, cut=None):
+    """Forward loopback connects to port and count the bytes, return (proxy port, counter).
+
+    counter["open"] is the count of connects not finished yet. If
+    counter["cut"] is set, the connect passing that many bytes in all is
+    dropped, as a network failure, and counter["cut"] is cleared.
+    """
+
+    counter = {"bytes": 0, "open": 0, "cut": cut, "lock": threading.Lock()}
+    server = socket.create_server(("127.0.0.1", 0))
+
+    def pipe(src, dst):
+        with src, dst:
+            while True:
+                try:
+                    data = src.recv(1 << 16)
+                    if not data:
+                        break
+                    with counter["lock"]:
+                        counter["bytes"] = counter["bytes"] + len(data)
+                        drop = counter["cut"] is not None and counter["bytes"] >= counter["cut"]
+                        if drop:
+                            counter["cut"] = None
+                    if drop:
+                        for con in (src, dst):
+                            with contextlib.suppress(OSError):
+                                con.shutdown(socket.SHUT_RDWR)
+                        break
+                    dst.sendall(data)
+                except OSError:
+                    break
+            with contextlib.suppress(OSError):
+                dst.shutdown(socket.SHUT_WR)
+        with counter["lock"]:
+            counter["open"] = counter["open"] - 1
+
+    def accept():
+        while True:
+            client, addr = server.accept()
+            upstream = socket.create_connection(("127.0.0.1", port))
+            with counter["lock"]:
+                counter["open"] = counter["open"] + 2
+            threading.Thread(target=pipe, args=(client, upstream.dup()), daemon=True).start()
+            threading.Thread(target=pipe, args=(upstream, client.dup()), daemon=True).start()
+
+    threading.Thread(target=accept, daemon=True).start()
+    return server.getsockname()[1], counter
+
+
+def benchFanout(peers=8, count=200, size=65536, fanouts=("star", "chain", "tree")):
+    """Push a tree to peers local servers by each fanout, report time and bytes through the source."""
+
+    rows = []
+    for fanout in fanouts:
+        with tempfile.TemporaryDirectory() as tmp:
+            source = os.path.join(tmp, "source")
+            makeSynthetic(source, count, [(size, 1)])
+            total = sum(os.path.getsize(os.path.join(d, name)) for d, subs, files in os.walk(source) for name in files)
+            direct = len(FileSync.FileSync.planFanout(None, list(range(peers)), fanout, 2))
+            specs = []
+            counters = []
+            for i in range(peers):
+                root = os.path.join(tmp, "peer" + str(i))
+                os.makedirs(root)
+                port = startServer(os.path.join(tmp, "server" + str(i)), root, {"peers": {"relay": "127.0.0.1"}})
+                if i < direct:  # bytes of the source go through these
+                    port, counter = countingProxy(port)
+                    counters.append(counter)
+                specs.append("127.0.0.1:" + str(port) + "=" + root)
+            os.makedirs(os.path.join(tmp, "client"))
+            client = FileSync.FileSync(makeConfig(os.path.join(tmp, "client"), source,
+                                                  options={"peers": {"fanout": fanout}}))
+            with contextlib.redirect_stdout(open(os.devnull, "w")):
+                start = time.perf_counter()
+                reached = client.fanOut(specs, source, source)
+                used = time.perf_counter() - start
+            while any(counter["open"] for counter in counters):
+                time.sleep(0.01)
+            sent = sum(counter["bytes"] for counter in counters)
+            complete = sum(1 for i in range(peers)
+                           if sum(len(files) for d, s, files in os.walk(os.path.join(tmp, "peer" + str(i)))) == count)
+            rows.append((fanout, used, sent))
+            print("fanout %s to %d peers: %d reached, %d complete in %.3fs, source sent %.1f MB, %.1fx the tree"
+                  % (fanout, peers, reached, complete, used, sent / 1e6, sent / total))
+    return rows
+
+
+def makeCert(folder):
+    """Make a self-signed cert and key by openssl in folder, return their paths."""
+
+    cert = os.path.join(folder, "cert.pem")
+    key = os.path.join(folder, "key.pem")
+    subprocess.run(["openssl", "req", "-x509", "-newkey", "ec", "-pkeyopt", "ec_paramgen_curve:prime256v1",
+                    "-nodes", "-days", "1", "-subj", "/CN=filesync", "-keyout", key, "-out", cert],
+                   check=True, capture_output=True)
+    return cert, key
+
+
+def benchTls(size=256 << 20, count=2000, cycles=5):
+    """Pull a large file and small files in plaintext and by TLS, report throughput and resumed handshakes."""
+
+    rows = []
+    for mode in ("plain", "tls"):
+        with tempfile.TemporaryDirectory() as tmp:
+            remote = os.path.join(tmp, "remote")
+            local = os.path.join(tmp, "local")
+            makeTree(os.path.join(remote, "small"), count, 1000)
+            makeFile(os.path.join(remote, "large.bin"), size)
+            os.makedirs(local)
+            options = {"compress": {"codec": "none"}}
+            if mode == "tls":
+                cert, key = makeCert(tmp)   # shared by both sides
+                options["tls"] = {"cert": cert, "key": key}
+            port = startServer(tmp, remote, options)
+            used, client = runSync(tmp, local, remote, port, options)
+            total = size + count * 1000
+            resync = [runCycle(client)[0] for i in range(cycles)]
+            totals = client.metrics.totals
+            rows.append((mode, used, sum(resync) / cycles))
+            print("tls %s: %d MB in %.3fs, %.1f MB/s, resync %.3fs, %d full and %d resumed handshakes"
+                  % (mode, total >> 20, used, total / used / 1e6, sum(resync) / cycles,
+                     totals["tls_handshakes"], totals["tls_resumed"]))
+    return rows
+
+
+def benchResume(size=48 << 20):
+    """Drop the pull of a large file half way, check the next sync resumes it and the file matches.
+
+    size is between resumemin and checkpoint of the default config, so
+    the only checkpoint is the one saved when the connect is lost.
+    """
+
+    with tempfile.TemporaryDirectory() as tmp:
+        remote = os.path.join(tmp, "remote")
+        local = os.path.join(tmp, "local")
+        os.makedirs(remote)
+        os.makedirs(local)
+        with open(os.path.join(remote, "small.txt"), "w") as fp:
+            fp.write("synced first")
+        options = {"compress": {"codec": "none"}, "transfer": {"workers": 1}}
+        port, counter = countingProxy(startServer(tmp, remote, options))
+        os.makedirs(os.path.join(tmp, "client"))
+        client = FileSync.FileSync(makeConfig(os.path.join(tmp, "client"), local, remote, port, options))
+        runCycle(client)
+        synctime = client.synctime
+        time.sleep(1.1)     # files of the second of last sync are not listed
+        makeFile(os.path.join(remote, "large.bin"), size)
+        time.sleep(1.1)
+        counter["cut"] = counter["bytes"] + size // 2
+        with contextlib.suppress(OSError):
+            runCycle(client)
+        partial = os.path.getsize(os.path.join(local, "large.bin" + client.PARTIAL))
+        assert client.synctime == synctime, "sync time is saved after a lost transfer"
+        assert not os.path.exists(os.path.join(local, "large.bin")), "a dropped file is committed"
+        counter["bytes"] = 0
+        used, summary = runCycle(client)
+        with open(os.path.join(remote, "large.bin"), "rb") as a, open(os.path.join(local, "large.bin"), "rb") as b:
+            assert a.read() == b.read(), "resumed file does not match"
+        assert counter["bytes"] < size - partial + (1 << 20), "transfer is not resumed"
+        assert client.synctime != synctime
+        print("resume %d MB: dropped at %.1f MB, resumed with %.1f MB on wire in %.3fs, file matches"
+              % (size >> 20, partial / 1e6, counter["bytes"] / 1e6, used))
+        return partial, counter["bytes"]
+
+
+def roundTrip(sync, old, new, out):
+    """Send delta of file new against old over a socket pair, rebuild it to out, return (wire, seconds)."""
+
+    signature = sync.makeSignature(old)
+    blocksize = sync.SIG_HEAD.unpack_from(signature)[0]
+    a, b = socket.socketpair()
+    result = {}
+
+    def send():
+        with open(new, "rb") as fp:
+            result["wire"], result["matched"] = sync.sendDelta(a, fp, signature)
+
+    start = time.perf_counter()
+    t = threading.Thread(target=send)
+    t.start()
+    with open(out, "wb") as fp:
+        type, length = sync.recvHead(b)
+        sync.recvDelta(b, old, fp, blocksize, type, length)
+    t.join()
+    used = time.perf_counter() - start
+    a.close()
+    b.close()
+    return result["wire"], used
+
+
+def benchDelta(sync, size=8 << 20, change=100003):
+    """Delta an insert, a delete and a prepend of change bytes in a random file, check the bytes on wire."""
+
+    rows = []
+    with tempfile.TemporaryDirectory() as tmp:
+        old = os.path.join(tmp, "old.bin")
+        with open(old, "wb") as fp:
+            fp.write(os.urandom(size))
+        with open(old, "rb") as fp:
+            content = fp.read()
+        extra = os.urandom(change)
+        cases = (("insert", content[:size // 2] + extra + content[size // 2:]),
+                 ("delete", content[:size // 2] + content[size // 2 + change:]),
+                 ("prepend", extra + content))
+        for name, data in cases:
+            new = os.path.join(tmp, name + ".bin")
+            out = os.path.join(tmp, name + ".out")
+            with open(new, "wb") as fp:
+                fp.write(data)
+            wire, used = roundTrip(sync, old, new, out)
+            with open(out, "rb") as fp:
+                assert fp.read() == data, "delta of " + name + " rebuilds a different file"
+            blocksize = sync.SIG_HEAD.unpack_from(sync.makeSignature(old))[0]
+            # the change, and the blocks it touches, are sent as literal data
+            assert wire < change + 4 * blocksize + 4096, "delta of " + name + " sends " + str(wire) + " bytes"
+            rows.append((name, wire, used))
+            print("delta %s of %d bytes in %d MB: %d bytes on wire in %.3fs"
+                  % (name, change, size >> 20, wire, used))
+    return rows
+
+
+def benchRename(count=200, size=262144):
+    """Sync after a directory is renamed on each side, report bytes on wire."""
+
+    rows = []
+    for name, dedupmin in (("transfer", 1 << 62), ("detect", 4096)):
+        with tempfile.TemporaryDirectory() as tmp:
+            remote = os.path.join(tmp, "remote")
+            local = os.path.join(tmp, "local")
+            for i in range(count):
+                folder = os.path.join(remote, "d" + str(i * 2 // count))
+                os.makedirs(folder, exist_ok=True)
+                with open(os.path.join(folder, "f" + str(i)), "wb") as fp:
+                    fp.write(os.urandom(size))
+            shutil.copytree(remote, local)
+            os.rename(os.path.join(remote, "d0"), os.path.join(remote, "renamed"))
+            os.rename(os.path.join(local, "d1"), os.path.join(local, "moved"))
+            options = {"transfer": {"dedupmin": dedupmin}, "compress": {"codec": "none"}}
+            port, counter = countingProxy(startServer(tmp, remote, options))
+            used, client = runSync(tmp, local, remote, port, options)
+            while counter["open"]:  # the server is still saving pushed files
+                time.sleep(0.05)
+            rows.append((name, counter["bytes"], used))
+            print("rename %s: %d files of %d bytes renamed, %d bytes on wire in %.3fs"
+                  % (name, count, count * size, counter["bytes"], used))
+    return rows
+
+
+class SlowEntry():
+    """DirEntry whose first stat waits like on a network mount."""
+
+    def __init__(self, entry, latency):
+        self.entry = entry
+        self.latency = latency
+        self.name = entry.name
+        self.path = entry.path
+        self.cached = None
+
+    def stat(self):
+        if self.cached is None:
+            time.sleep(self.latency)
+            self.cached = self.entry.stat()
+        return self.cached
+
+    def is_dir(self):
+        return self.entry.is_dir()
+
+    def is_symlink(self):
+        return self.entry.is_symlink()
+
+    def inode(self):
+        return self.entry.inode()
+
+
+@contextlib.contextmanager
+def statLatency(latency):
+    """Add latency seconds to every os.stat and DirEntry.stat while in the context."""
+
+    stat = os.stat
+    scandir = os.scandir
+
+    def slowStat(path, *args, **kwargs):
+        time.sleep(latency)
+        return stat(path, *args, **kwargs)
+
+    class SlowScandir():
+        def __init__(self, path="."):
+            time.sleep(latency)
+            self.it = scandir(path)
+
+        def __iter__(self):
+            return self
+
+        def __next__(self):
+            return SlowEntry(next(self.it), latency)
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *args):
+            self.it.close()
+
+        def close(self):
+            self.it.close()
+
+    os.stat = slowStat
+    os.scandir = SlowScandir
+    try:
+        yield
+    finally:
+        os.stat = stat
+        os.scandir = scandir
+
+
+def benchScan(count, latency=0.001, scanners=(1, 8, 32)):
+    """Scan a tree of count files with stat latency, cold and unchanged, by each count of scanners."""
+
+    rows = []
+    with tempfile.TemporaryDirectory() as tmp:
+        root = os.path.join(tmp, "tree")
+        makeTree(root, count)
+        with statLatency(latency):
+            start = time.perf_counter()
+            walkFolder(root)
+            walk = time.perf_counter() - start
+        print("scan %d files, %.1f ms a stat: os.walk %.3fs" % (count, latency * 1e3, walk))
+        for n in scanners:
+            folder = os.path.join(tmp, str(n))
+            os.makedirs(folder)
+            sync = FileSync.FileSync(makeConfig(folder, root, options={"index": {"scanners": n}}))
+            with statLatency(latency), contextlib.redirect_stdout(open(os.devnull, "w")):
+                start = time.perf_counter()
+                found = len(sync.getFolder(root))
+                cold = time.perf_counter() - start
+                start = time.perf_counter()
+                sync.getFolder(root)
+                warm = time.perf_counter() - start
+            sync.getIndex().close()
+            rows.append((n, cold, warm))
+            print("scan %d files by %2d scanners: cold %.3fs, unchanged %.3fs, %.0f entries/s"
+                  % (found, n, cold, warm, found / cold))
+    return rows
+
+
+if __name__ == "__main__":
+    scenario = sys.argv[1] if len(sys.argv) > 1 else "diff"
+    sync = FileSync.FileSync()
+    if scenario == "diff":
+        sizes = sys.argv[2] if len(sys.argv) > 2 else "1k,10k,100k,1m"
+        benchDiff(sync, [parseCount(n) for n in sizes.split(",")])
+    if scenario == "listing":
+        sizes = sys.argv[2] if len(sys.argv) > 2 else "1k,100k,1m"
+        benchListing(sync, [parseCount(n) for n in sizes.split(",")])
+    if scenario == "memory":
+        sizes = sys.argv[2] if len(sys.argv) > 2 else "100k,1m"
+        benchMemory(sync, [parseCount(n) for n in sizes.split(",")])
+    if scenario == "transfer":
+        sizes = sys.argv[2] if len(sys.argv) > 2 else "1m,100m,5g"
+        benchTransfer(sync, [parseCount(n) for n in sizes.split(",")])
+    if scenario == "index":
+        sizes = sys.argv[2] if len(sys.argv) > 2 else "10k,100k"
+        benchIndex([parseCount(n) for n in sizes.split(",")])
+    if scenario == "server":
+        benchServer(int(sys.argv[2]) if len(sys.argv) > 2 else 50)
+    if scenario == "bundle":
+        benchBundle(parseCount(sys.argv[2]) if len(sys.argv) > 2 else 100000)
+    if scenario == "compress":
+        benchCompress(parseCount(sys.argv[2]) if len(sys.argv) > 2 else 100 << 20)
+    if scenario == "tree":
+        benchTree(parseCount(sys.argv[2]) if len(sys.argv) > 2 else 100000)
+    if scenario == "rename":
+        benchRename()
+    if scenario == "scan":
+        benchScan(parseCount(sys.argv[2]) if len(sys.argv) > 2 else 20000)
+    if scenario == "fanout":
+        benchFanout(int(sys.argv[2]) if len(sys.argv) > 2 else 8)
+    if scenario == "tls":
+        benchTls(parseCount(sys.argv[2]) if len(sys.argv) > 2 else 256 << 20)
+    if scenario == "delta":
+        benchDelta(sync, parseCount(sys.argv[2]) if len(sys.argv) > 2 else 8 << 20)
+    if scenario == "resume":
+        benchResume(parseCount(sys.argv[2]) if len(sys.argv) > 2 else 48 << 20)
+    if scenario == "schedule":
+        benchSchedule()
+    if scenario == "suite":
+        benchSuite(**dict(arg.split("=", 1) for arg in sys.argv[2:]))
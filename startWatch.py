@@ -0,0 +1,4 @@
+import FileSync
+
+client = FileSync.FileSync()
+client.startWatch()